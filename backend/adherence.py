@@ -0,0 +1,156 @@
+"""
+Daily adherence rollups for Medilog
+
+One small document per (user_id, date, medication_id) in the
+daily_adherence collection, kept current with atomic $inc updates whenever
+a dose log is stored or changes status:
+
+    scheduled  number of stored dose logs scheduled on that day
+    taken / missed / skipped  how many of them are in that status
+"""
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from dates import parse_datetime
+from models import DoseStatus, MedicationSchedule
+from scheduling import CompiledSchedule
+
+STATUS_COUNTERS = {
+    DoseStatus.TAKEN: "taken",
+    DoseStatus.MISSED: "missed",
+    DoseStatus.SKIPPED: "skipped",
+}
+COUNTERS = ("scheduled", "taken", "missed", "skipped")
+
+
+def rollup_date(scheduled_time) -> str:
+    """YYYY-MM-DD day a dose belongs to"""
+    return parse_datetime(scheduled_time).strftime("%Y-%m-%d")
+
+
+def status_increments(
+    old_status: Optional[str],
+    new_status: Optional[str],
+    stored: int = 0
+) -> Dict[str, int]:
+    """Counter deltas for a dose moving from old_status to new_status.
+
+    `stored` is +1 when the dose log document was just created and -1 when it
+    was removed; use None for the status on the side that does not exist.
+    """
+    increments = {}
+    if stored:
+        increments["scheduled"] = stored
+    if old_status != new_status:
+        if old_status in STATUS_COUNTERS:
+            increments[STATUS_COUNTERS[old_status]] = -1
+        if new_status in STATUS_COUNTERS:
+            key = STATUS_COUNTERS[new_status]
+            increments[key] = increments.get(key, 0) + 1
+    return increments
+
+
+def expected_counts(
+    medications: Iterable[dict],
+    window_start: datetime,
+    window_end: datetime
+) -> Dict[Tuple[str, str], int]:
+    """Number of schedule occurrences per (medication_id, date) in the window"""
+    counts = {}
+    for med in medications:
+        schedule = CompiledSchedule(MedicationSchedule(**med))
+        for scheduled_time in schedule.occurrences(window_start, window_end):
+            key = (schedule.medication.id, rollup_date(scheduled_time))
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def rollup_filter(user_id: str, medication_id: str, scheduled_time) -> dict:
+    """Key of the rollup document a dose counts towards"""
+    return {"user_id": user_id, "date": rollup_date(scheduled_time), "medication_id": medication_id}
+
+
+def rollup_change(increments: Dict[str, int]) -> dict:
+    return {"$inc": increments, "$set": {"updated_at": datetime.utcnow()}}
+
+
+def rollup_update(user_id: str, medication_id: str, scheduled_time, increments: Dict[str, int]) -> UpdateOne:
+    """Upserting $inc on the rollup document of the dose's day, for bulk writes"""
+    return UpdateOne(
+        rollup_filter(user_id, medication_id, scheduled_time),
+        rollup_change(increments),
+        upsert=True
+    )
+
+
+async def record_dose_change(
+    db,
+    dose: dict,
+    old_status: Optional[str],
+    new_status: Optional[str],
+    stored: int = 0
+):
+    """Apply a single dose transition to its daily rollup"""
+    increments = status_increments(old_status, new_status, stored)
+    if not increments:
+        return
+    await db.daily_adherence.update_one(
+        rollup_filter(dose["user_id"], dose["medication_id"], dose["scheduled_time"]),
+        rollup_change(increments),
+        upsert=True
+    )
+
+
+def _counter_sums() -> dict:
+    """$group accumulators for the rollup counters"""
+    sums = {"scheduled": {"$sum": 1}}
+    for status, counter in STATUS_COUNTERS.items():
+        sums[counter] = {"$sum": {"$cond": [{"$eq": ["$status", status.value]}, 1, 0]}}
+    return sums
+
+
+def _day_and_medication_groups() -> List[dict]:
+    """Stages grouping matched dose logs into rollup-shaped rows"""
+    return [
+        {"$group": {
+            "_id": {
+                "date": {"$dateToString": {"format": "%Y-%m-%d", "date": "$scheduled_time"}},
+                "medication_id": "$medication_id"
+            },
+            **_counter_sums()
+        }},
+        {"$project": {
+            "_id": 0,
+            "date": "$_id.date",
+            "medication_id": "$_id.medication_id",
+            **{counter: 1 for counter in COUNTERS}
+        }},
+    ]
+
+
+def progress_pipeline(user_id: str, start: datetime, end: datetime) -> List[dict]:
+    """Count a user's dose logs in [start, end] entirely inside MongoDB.
+
+    Returns one document with `totals` (a single row of counters) and `days`
+    (counters per date and medication), so no dose log leaves the server.
+    """
+    return [
+        {"$match": {
+            "user_id": user_id,
+            "scheduled_time": {"$gte": start, "$lte": end}
+        }},
+        {"$facet": {
+            "totals": [
+                {"$group": {"_id": None, **_counter_sums()}},
+                {"$project": {"_id": 0}},
+            ],
+            "days": _day_and_medication_groups() + [{"$sort": {"date": 1}}],
+        }},
+    ]
+
+
+def backfill_pipeline(user_id: str) -> List[dict]:
+    """Rollup rows for all of a user's stored dose logs"""
+    return [{"$match": {"user_id": user_id}}] + _day_and_medication_groups()
@@ -0,0 +1,182 @@
+"""
+Drug image analysis client for Medilog
+
+One DrugImageAnalyzer is created at application startup and shared by all
+requests. It wraps an async backend (the Anthropic API, or a local stub for
+tests and offline development selected with AI_BACKEND=stub), reuses its
+HTTP connections and limits concurrent outbound calls with a semaphore.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+from typing import Optional
+
+import anthropic
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+AI_BACKEND = os.getenv("AI_BACKEND", "anthropic")
+AI_MODEL = os.getenv("AI_MODEL", "claude-3-5-sonnet-20241022")
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))
+AI_TIMEOUT_SECONDS = float(os.getenv("AI_TIMEOUT_SECONDS", "60"))
+AI_MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", "2"))
+AI_STUB_LATENCY_SECONDS = float(os.getenv("AI_STUB_LATENCY_SECONDS", "0"))
+
+ANALYSIS_PROMPT = """Analyze this drug/medication box image and extract the following information in JSON format:
+{
+  "name": "Commercial drug name",
+  "active_ingredient": "Active ingredient name",
+  "description": "Brief description",
+  "dosage_forms": ["tablet", "capsule", etc],
+  "standard_dosages": ["10mg", "20mg", etc],
+  "category": "Drug category"
+}
+
+If this is not a medication box or you cannot extract the information, return:
+{
+  "error": "Unable to extract drug information from image"
+}
+
+IMPORTANT: Return ONLY valid JSON, no additional text."""
+
+STUB_DRUG_INFO = {
+    "name": "Coraspin 100 mg",
+    "active_ingredient": "Asetilsalisilik Asit (ASA)",
+    "description": "Kalp krizi ve inme riskini azaltan kan sulandırıcı ilaç",
+    "dosage_forms": ["tablet"],
+    "standard_dosages": ["100mg"],
+    "category": "Antiplatelet / Kan Sulandırıcı",
+}
+
+
+class AnthropicBackend:
+    """Claude Vision through a single pooled AsyncAnthropic client"""
+
+    def __init__(self, api_key: str):
+        # The SDK retries connection errors, 429s and 5xx with backoff
+        self.client = anthropic.AsyncAnthropic(
+            api_key=api_key,
+            timeout=AI_TIMEOUT_SECONDS,
+            max_retries=AI_MAX_RETRIES,
+        )
+
+    async def complete(self, base64_image: str, media_type: str) -> str:
+        message = await self.client.messages.create(
+            model=AI_MODEL,
+            max_tokens=1024,
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": media_type,
+                                "data": base64_image,
+                            },
+                        },
+                        {"type": "text", "text": ANALYSIS_PROMPT},
+                    ],
+                }
+            ],
+        )
+        return message.content[0].text
+
+    async def close(self):
+        await self.client.close()
+
+
+class StubBackend:
+    """Local canned response, for tests and running without an API key"""
+
+    def __init__(self, response: Optional[str] = None, latency: float = AI_STUB_LATENCY_SECONDS):
+        self.response = response or json.dumps(STUB_DRUG_INFO, ensure_ascii=False)
+        self.latency = latency
+
+    async def complete(self, base64_image: str, media_type: str) -> str:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.response
+
+    async def close(self):
+        pass
+
+
+def parse_analysis(response_text: str) -> dict:
+    """Turn the model's reply into the endpoint's {"success", "data"/"message"} shape"""
+    try:
+        drug_info = json.loads(response_text)
+    except json.JSONDecodeError:
+        # Try to extract JSON from text if the model added extra text
+        json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
+        if not json_match:
+            return {"success": False, "message": "Could not parse AI response"}
+        try:
+            drug_info = json.loads(json_match.group())
+        except json.JSONDecodeError:
+            return {"success": False, "message": "Could not parse AI response"}
+
+    if "error" in drug_info:
+        return {"success": False, "message": drug_info["error"]}
+    return {"success": True, "data": drug_info}
+
+
+class DrugImageAnalyzer:
+    """Shared, concurrency-limited entry point for image analysis"""
+
+    def __init__(self, backend, max_concurrency: int = AI_MAX_CONCURRENCY):
+        self.backend = backend
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+
+    async def analyze(self, base64_image: str, media_type: str) -> dict:
+        if self.backend is None:
+            raise HTTPException(status_code=500, detail="AI API key not configured")
+
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                response_text = await self.backend.complete(base64_image, media_type)
+            except anthropic.APITimeoutError:
+                self.timeouts += 1
+                raise HTTPException(status_code=504, detail="AI analysis timed out")
+            except anthropic.APIError as e:
+                self.failed += 1
+                logger.error(f"AI analysis failed: {e}")
+                raise HTTPException(status_code=502, detail="AI analysis failed")
+            finally:
+                self.in_flight -= 1
+
+        self.completed += 1
+        return parse_analysis(response_text)
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self.backend).__name__ if self.backend else None,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+        }
+
+    async def close(self):
+        if self.backend is not None:
+            await self.backend.close()
+
+
+def create_analyzer() -> DrugImageAnalyzer:
+    """Build the analyzer for the configured backend"""
+    if AI_BACKEND == "stub":
+        return DrugImageAnalyzer(StubBackend())
+    api_key = os.getenv("ANTHROPIC_API_KEY")
+    if not api_key:
+        logger.warning("ANTHROPIC_API_KEY is not set; drug image analysis is disabled")
+        return DrugImageAnalyzer(None)
+    return DrugImageAnalyzer(AnthropicBackend(api_key))
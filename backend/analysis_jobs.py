@@ -0,0 +1,153 @@
+"""
+Batch drug image analysis jobs
+
+A batch upload is stored as a job document in the analysis_jobs collection
+and analyzed in a background task, all images concurrently; the images
+queue for the shared image pool rather than being refused when it is busy,
+and the DrugImageAnalyzer's semaphore bounds outbound model calls across
+all jobs.
+Each image's result is written to the job as soon as it is ready, so
+clients can poll the job or stream results. While a job runs its worker
+renews heartbeat_at; a job whose heartbeat is older than
+ANALYSIS_JOB_STALE_SECONDS (its worker crashed or was restarted) is marked
+failed when next read. Jobs are removed by a TTL index once expires_at has
+passed.
+"""
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+
+from documents import from_document, to_document
+from models import AnalysisJob, AnalysisJobStatus, ImageAnalysisResult
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_IMAGES = int(os.getenv("MAX_BATCH_IMAGES", "10"))
+ANALYSIS_JOB_TTL_HOURS = float(os.getenv("ANALYSIS_JOB_TTL_HOURS", "24"))
+# How often a result stream re-reads the job document
+JOB_POLL_INTERVAL_SECONDS = 0.5
+JOB_HEARTBEAT_SECONDS = 10.0
+ANALYSIS_JOB_STALE_SECONDS = float(os.getenv("ANALYSIS_JOB_STALE_SECONDS", "60"))
+INTERRUPTED_MESSAGE = "Analysis was interrupted, please retry"
+UNFINISHED = (AnalysisJobStatus.PENDING, AnalysisJobStatus.RUNNING)
+
+class AnalysisJobRunner:
+    """Creates batch jobs and runs them in background tasks"""
+
+    def __init__(self, collection, analyze: Callable[[bytes], Awaitable[dict]]):
+        self.collection = collection
+        self.analyze = analyze
+        self._tasks = set()
+
+    async def submit(self, user_id: str, uploads: List[Tuple[Optional[str], bytes]]) -> AnalysisJob:
+        """Store a job for (filename, contents) uploads and start analyzing them"""
+        job = AnalysisJob(
+            user_id=user_id,
+            total=len(uploads),
+            results=[ImageAnalysisResult(index=i, filename=name) for i, (name, _) in enumerate(uploads)],
+            expires_at=datetime.utcnow() + timedelta(hours=ANALYSIS_JOB_TTL_HOURS),
+        )
+        await self.collection.insert_one(to_document(job))
+
+        task = asyncio.create_task(self._run(job.id, [contents for _, contents in uploads]))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def _run(self, job_id: str, images: List[bytes]):
+        await self.collection.update_one(
+            {"_id": job_id}, {"$set": {"status": AnalysisJobStatus.RUNNING, "heartbeat_at": datetime.utcnow()}}
+        )
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            await asyncio.gather(*(self._analyze_one(job_id, i, contents) for i, contents in enumerate(images)))
+        finally:
+            heartbeat.cancel()
+            await self.collection.update_one(
+                {"_id": job_id, "status": AnalysisJobStatus.RUNNING},
+                {"$set": {"status": AnalysisJobStatus.COMPLETED}}
+            )
+
+    async def _heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                await self.collection.update_one({"_id": job_id}, {"$set": {"heartbeat_at": datetime.utcnow()}})
+            except Exception as e:
+                logger.error(f"Error renewing heartbeat of job {job_id}: {e}")
+
+    async def _analyze_one(self, job_id: str, index: int, contents: bytes):
+        try:
+            outcome = await self.analyze(contents)
+        except HTTPException as e:
+            outcome = {"success": False, "message": e.detail}
+        except Exception as e:
+            logger.error(f"Error analyzing image {index} of job {job_id}: {e}")
+            outcome = {"success": False, "message": "Analysis failed"}
+
+        result = {
+            f"results.{index}.status": "success" if outcome["success"] else "failed",
+            f"results.{index}.data": outcome.get("data"),
+            f"results.{index}.message": outcome.get("message"),
+        }
+        await self.collection.update_one({"_id": job_id}, {"$set": result, "$inc": {"completed": 1}})
+
+    async def get(self, job_id: str, user_id: str) -> dict:
+        job = await self.collection.find_one({"_id": job_id, "user_id": user_id})
+        if not job:
+            raise HTTPException(status_code=404, detail="Analysis job not found")
+        if job["status"] in UNFINISHED:
+            job = await self._fail_if_stale(job)
+        return from_document(job)
+
+    async def _fail_if_stale(self, job: dict) -> dict:
+        """Mark a job failed when no worker has renewed its heartbeat in time"""
+        last_seen = job.get("heartbeat_at") or job["created_at"]
+        if last_seen > datetime.utcnow() - timedelta(seconds=ANALYSIS_JOB_STALE_SECONDS):
+            return job
+        update = {"status": AnalysisJobStatus.FAILED}
+        for result in job["results"]:
+            if result["status"] == "pending":
+                update[f"results.{result['index']}.status"] = "failed"
+                update[f"results.{result['index']}.message"] = INTERRUPTED_MESSAGE
+        # Guarded on the heartbeat read, in case the worker was only late
+        stale = await self.collection.find_one_and_update(
+            {"_id": job["_id"], "status": job["status"], "heartbeat_at": job.get("heartbeat_at")},
+            {"$set": update},
+            return_document=ReturnDocument.AFTER
+        )
+        if stale is not None:
+            logger.warning(f"Analysis job {job['_id']} marked failed, its worker stopped")
+            return stale
+        return await self.collection.find_one({"_id": job["_id"]}) or job
+
+    async def stream(self, job_id: str, user_id: str) -> AsyncIterator[str]:
+        """NDJSON lines: each image result once it is finished, then the job summary"""
+        job = await self.get(job_id, user_id)
+        sent = set()
+        while True:
+            for result in job["results"]:
+                if result["status"] != "pending" and result["index"] not in sent:
+                    sent.add(result["index"])
+                    yield json.dumps(result, ensure_ascii=False) + "\n"
+            if job["status"] not in UNFINISHED or len(sent) == job["total"]:
+                break
+            await asyncio.sleep(JOB_POLL_INTERVAL_SECONDS)
+            try:
+                job = await self.get(job_id, user_id)
+            except HTTPException:
+                # Expired while streaming; the response has already started
+                job["status"] = AnalysisJobStatus.FAILED
+                break
+        status = job["status"] if job["status"] not in UNFINISHED else AnalysisJobStatus.COMPLETED
+        yield json.dumps({"id": job_id, "status": AnalysisJobStatus(status).value, "total": job["total"]}) + "\n"
+
+    def cancel_all(self):
+        for task in self._tasks:
+            task.cancel()
@@ -1,14 +1,22 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from motor.motor_asyncio import AsyncIOMotorDatabase
 import os
+from cache import TTLCache
+from documents import from_document
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing; hashes with a different cost are upgraded on login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 # JWT settings
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production-please-use-env-variable")
@@ -18,6 +26,12 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 # HTTP Bearer security
 security = HTTPBearer()
 
+# Authenticated users, keyed by token subject (email); never holds the password hash
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "30"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "10000"))
+user_cache = TTLCache(maxsize=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+USER_PRINCIPAL_PROJECTION = {"hashed_password": 0}
+
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against a hash"""
@@ -29,6 +43,68 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+class PasswordHasher:
+    """Runs bcrypt in a dedicated, size-limited thread pool.
+
+    bcrypt takes tens to hundreds of milliseconds per call, which would stall
+    the event loop. At most `max_pending` calls may be queued or running;
+    beyond that callers get a 503 instead of piling up.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.pending = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._total_seconds = 0.0
+        self._max_seconds = 0.0
+
+    async def _run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server busy, please retry",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.pending -= 1
+            self.completed += 1
+            self._total_seconds += elapsed
+            self._max_seconds = max(self._max_seconds, elapsed)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(pwd_context.hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """Verify a password; also returns a new hash when the stored one uses an outdated cost"""
+        return await self._run(pwd_context.verify_and_update, password, hashed_password)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.pending,
+            "peak_queue_depth": self.peak_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_latency_ms": round(self._total_seconds / self.completed * 1000, 2) if self.completed else 0.0,
+            "max_latency_ms": round(self._max_seconds * 1000, 2),
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create a JWT access token"""
     to_encode = data.copy()
@@ -64,13 +140,22 @@ async def get_current_user(
     if db is None:
         raise HTTPException(status_code=500, detail="Database connection error")
 
-    user = await db.users.find_one({"email": email})
+    user = user_cache.get(email)
     if user is None:
-        raise credentials_exception
+        user = await db.users.find_one({"email": email}, USER_PRINCIPAL_PROJECTION)
+        if user is None:
+            raise credentials_exception
+        user = from_document(user)
+        user_cache.set(email, user)
 
     return user
 
 
+def invalidate_user(email: str):
+    """Drop a cached user after a write to their document (push token, activation, profile)"""
+    user_cache.delete(email)
+
+
 async def get_current_active_user(current_user: dict = Depends(get_current_user)):
     """Verify that the current user is active"""
     if not current_user.get("is_active", False):
@@ -0,0 +1,86 @@
+"""
+Micro-benchmark: CPU time to serialize a dose log list response
+
+Compares the previous path (build DoseLog models, then let FastAPI validate
+and serialize them through response_model=List[DoseLog] into a JSONResponse)
+with the current one (shape the stored documents and encode with orjson).
+
+    python benchmark_responses.py [--doses 1000] [--rounds 50]
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+
+from ids import format_id
+from models import DoseLog
+from responses import json_response
+
+
+def sample_documents(count: int) -> List[dict]:
+    """Dose log documents as stored in MongoDB"""
+    start = datetime(2025, 1, 1, 8, 0)
+    docs = []
+    for i in range(count):
+        scheduled = start + timedelta(hours=12 * i)
+        docs.append({
+            "_id": format_id(int(scheduled.timestamp() * 1000), i),
+            "user_id": "01JGFJJZ00000000000000USER",
+            "medication_id": format_id(1735718400000, i % 4),
+            "drug_name": "Coraspin 100 mg",
+            "dosage": "100mg",
+            "scheduled_time": scheduled,
+            "actual_time": scheduled + timedelta(minutes=7) if i % 3 else None,
+            "status": "taken" if i % 3 else "missed",
+            "notes": None,
+            "side_effects_reported": ["nausea"] if i % 10 == 0 else [],
+            "created_at": scheduled,
+            "updated_at": scheduled,
+        })
+    return docs
+
+
+async def validated_response(field, docs: List[dict]) -> bytes:
+    content = await serialize_response(field=field, response_content=[DoseLog(**doc) for doc in docs])
+    return JSONResponse(content).body
+
+
+def fast_response(docs: List[dict]) -> bytes:
+    return json_response(docs, DoseLog).body
+
+
+def cpu_ms(run, rounds: int) -> float:
+    run()
+    started = time.process_time()
+    for _ in range(rounds):
+        run()
+    return (time.process_time() - started) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--doses", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    docs = sample_documents(args.doses)
+    field = create_model_field(name="Response_get_dose_logs", type_=List[DoseLog], mode="serialization")
+    loop = asyncio.new_event_loop()
+
+    before = cpu_ms(lambda: loop.run_until_complete(validated_response(field, docs)), args.rounds)
+    after = cpu_ms(lambda: fast_response(docs), args.rounds)
+    loop.close()
+
+    print(f"{args.doses} dose logs, {args.rounds} rounds (CPU ms per response)")
+    print(f"  models + response_model: {before:8.2f} ms")
+    print(f"  documents + orjson:      {after:8.2f} ms")
+    print(f"  speedup:                 {before / after:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+In-process caching helpers for Medilog
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries expire `ttl` seconds after being stored.
+
+    get_or_load() makes it a read-through cache: concurrent misses on the same
+    key share one load, and a load that started before an invalidation is not
+    stored, so an invalidated value cannot come back.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._loading: Dict[Hashable, asyncio.Future] = {}
+        self._generation = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        self._data.pop(key, None)
+        self._generation += 1
+
+    def clear(self):
+        self._data.clear()
+        self._generation += 1
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached value, loading it once for all concurrent callers on a miss"""
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        pending = self._loading.get(key)
+        if pending is not None:
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # The caller doing the shared load was cancelled; load again
+                return await self.get_or_load(key, loader)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        generation = self._generation
+        try:
+            value = await loader()
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            if generation == self._generation:
+                self.set(key, value)
+            return value
+        finally:
+            # A cancelled load (CancelledError is not an Exception) must not
+            # leave the waiters blocked on the shared future
+            if not future.done():
+                future.cancel()
+            del self._loading[key]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,58 @@
+"""
+Datetime handling for Medilog
+
+Timestamps are stored as native BSON dates. Like PyMongo's default
+(tz_aware=False), the application works with naive datetimes in UTC.
+Dose times of a schedule are the exception: "08:00" is the user's wall
+clock, so code acting on the real time (push reminders) converts them with
+the timezone the user's device reports.
+"""
+import os
+from datetime import datetime, timezone
+from typing import Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# For users whose device has not reported a timezone yet
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Europe/Istanbul")
+
+
+def parse_datetime(value) -> datetime:
+    """Parse an ISO string or datetime into a naive UTC datetime"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def mongo_precision(value: datetime) -> datetime:
+    """Truncate to milliseconds, the precision of BSON dates"""
+    return value.replace(microsecond=value.microsecond // 1000 * 1000)
+
+
+def load_timezone(name: Optional[str]) -> ZoneInfo:
+    """The named IANA timezone, or DEFAULT_TIMEZONE when missing or unknown"""
+    if name:
+        try:
+            return ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError):
+            pass
+    return ZoneInfo(DEFAULT_TIMEZONE)
+
+
+def is_timezone(name: str) -> bool:
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+    return True
+
+
+def to_local(value: datetime, zone: ZoneInfo) -> datetime:
+    """Naive UTC to naive wall-clock time in zone"""
+    return value.replace(tzinfo=timezone.utc).astimezone(zone).replace(tzinfo=None)
+
+
+def from_local(value: datetime, zone: ZoneInfo) -> datetime:
+    """Naive wall-clock time in zone to naive UTC"""
+    return value.replace(tzinfo=zone).astimezone(timezone.utc).replace(tzinfo=None)
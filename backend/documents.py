@@ -0,0 +1,34 @@
+"""
+Conversion between API models and stored MongoDB documents
+
+A model's `id` is stored as the document's `_id`, so every collection has a
+single unique key. Datetimes are stored in naive UTC (see dates.py).
+Models accept either key when built from a document. Legacy documents
+that migrate_ids.py has not converted yet keep their own `id` next to an
+ObjectId `_id`; the `id` wins, so their ObjectIds never reach references
+or responses.
+"""
+from datetime import datetime
+
+from pydantic import BaseModel
+
+from dates import parse_datetime
+
+
+def to_document(model: BaseModel) -> dict:
+    """A model as a MongoDB document: `id` becomes `_id`, datetimes naive UTC"""
+    document = model.dict()
+    for key, value in document.items():
+        if isinstance(value, datetime):
+            document[key] = parse_datetime(value)
+    if "id" in document:
+        document["_id"] = document.pop("id")
+    return document
+
+
+def from_document(document: dict) -> dict:
+    """A stored document with its `_id` exposed as `id` (a legacy `id` is kept)"""
+    document = dict(document)
+    if "_id" in document:
+        document.setdefault("id", document.pop("_id"))
+    return document
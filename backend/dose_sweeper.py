@@ -0,0 +1,252 @@
+"""
+Background sweep of overdue doses to MISSED
+
+Every few minutes one worker (holding the sweeper lease) marks doses that
+are still SCHEDULED a grace period after their time as MISSED, and moves
+their rollups along:
+
+- stored SCHEDULED dose logs are found through a partial index that only
+  holds SCHEDULED logs, and updated a batch at a time with update_many;
+- occurrences that were never stored are written as MISSED dose logs,
+  unless a log already exists for that medication and time. Each
+  medication records how far it has been swept (missed_swept_until, in
+  wall-clock time) and when its next occurrence falls due (missed_check_at,
+  in UTC), so a run only reads the medications that actually have a dose
+  falling due.
+
+Dose times are the user's wall clock, so the cutoff is converted to each
+user's timezone. Stored logs before the earliest local cutoff in use are
+overdue everywhere; those between the earliest and the latest are checked
+against their user's timezone.
+
+The cost of a run follows the number of doses that became overdue since
+the last one, not the size of dose_logs.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+from zoneinfo import ZoneInfo
+
+from pymongo import UpdateOne
+
+from adherence import rollup_update, status_increments
+from dates import from_local, load_timezone, mongo_precision, parse_datetime, to_local
+from leases import Lease
+from models import DoseStatus, MedicationSchedule
+from scheduling import CompiledSchedule, dose_key, schedules_in_effect, virtual_dose_document
+
+logger = logging.getLogger(__name__)
+
+MISSED_DOSE_GRACE_MINUTES = float(os.getenv("MISSED_DOSE_GRACE_MINUTES", "120"))
+# 0 disables the sweeper
+MISSED_DOSE_SWEEP_INTERVAL_SECONDS = float(os.getenv("MISSED_DOSE_SWEEP_INTERVAL_SECONDS", "300"))
+MISSED_DOSE_SWEEP_BATCH_SIZE = int(os.getenv("MISSED_DOSE_SWEEP_BATCH_SIZE", "1000"))
+# Oldest never-stored occurrence written as missed, e.g. on a medication's first sweep
+MISSED_DOSE_LOOKBACK_DAYS = float(os.getenv("MISSED_DOSE_LOOKBACK_DAYS", "30"))
+# How far ahead the next occurrence is looked for before checking again anyway
+NEXT_CHECK_HORIZON = timedelta(days=7)
+
+
+class MissedDoseSweeper:
+    """Periodically marks overdue SCHEDULED doses as MISSED"""
+
+    def __init__(
+        self,
+        db,
+        interval: float = MISSED_DOSE_SWEEP_INTERVAL_SECONDS,
+        grace_minutes: float = MISSED_DOSE_GRACE_MINUTES,
+        batch_size: int = MISSED_DOSE_SWEEP_BATCH_SIZE
+    ):
+        self.db = db
+        self.interval = interval
+        self.grace = timedelta(minutes=grace_minutes)
+        self.batch_size = batch_size
+        # Held across runs by the worker that sweeps; others take over once it lapses
+        self.lease = Lease(db.leases, "missed_dose_sweeper", duration=2 * interval)
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.last_run_at: Optional[datetime] = None
+        self.last_swept = 0
+        self.total_swept = 0
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        self._task = None
+        try:
+            await self.lease.release()
+        except Exception as e:
+            logger.error(f"Error releasing missed dose sweeper lease: {e}")
+
+    async def _loop(self):
+        while True:
+            try:
+                if await self.lease.acquire():
+                    await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error sweeping missed doses: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self, now: Optional[datetime] = None) -> int:
+        """Mark every dose overdue at `now` as missed; returns the number marked"""
+        cutoff = (now or datetime.utcnow()) - self.grace
+        swept = await self._sweep_stored(cutoff) + await self._sweep_unstored(cutoff)
+        self.runs += 1
+        self.last_run_at = datetime.utcnow()
+        self.last_swept = swept
+        self.total_swept += swept
+        logger.info(f"Missed dose sweep marked {swept} doses as missed")
+        return swept
+
+    async def _user_zones(self, user_ids: Iterable[str]) -> Dict[str, ZoneInfo]:
+        """Timezone of each user; users without one get DEFAULT_TIMEZONE"""
+        users = await self.db.users.find({"_id": {"$in": list(user_ids)}}, {"timezone": 1}).to_list(None)
+        return {user["_id"]: load_timezone(user.get("timezone")) for user in users}
+
+    async def _sweep_stored(self, cutoff: datetime) -> int:
+        zones = {load_timezone(name) for name in await self.db.users.distinct("timezone")}
+        zones.add(load_timezone(None))
+        local_cutoffs = [to_local(cutoff, zone) for zone in zones]
+        earliest, latest = min(local_cutoffs), max(local_cutoffs)
+
+        swept, batch = 0, []
+        cursor = self.db.dose_logs.find(
+            {"status": DoseStatus.SCHEDULED, "scheduled_time": {"$lt": latest}},
+            {"user_id": 1, "medication_id": 1, "scheduled_time": 1}
+        ).sort("scheduled_time", 1).batch_size(self.batch_size)
+        async for dose in cursor:
+            batch.append(dose)
+            if len(batch) < self.batch_size:
+                continue
+            swept += await self._mark_stored(batch, cutoff, earliest)
+            batch = []
+            if not await self.lease.acquire():
+                return swept
+        if batch:
+            swept += await self._mark_stored(batch, cutoff, earliest)
+        return swept
+
+    async def _mark_stored(self, batch: List[dict], cutoff: datetime, earliest: datetime) -> int:
+        """Mark the overdue logs of a batch as missed; logs from `earliest` on
+        are only overdue if their user's local cutoff has passed"""
+        undecided = {dose["user_id"] for dose in batch if parse_datetime(dose["scheduled_time"]) >= earliest}
+        if undecided:
+            zones = await self._user_zones(undecided)
+            batch = [
+                dose for dose in batch
+                if dose["user_id"] not in undecided
+                or parse_datetime(dose["scheduled_time"]) < to_local(cutoff, zones.get(dose["user_id"]) or load_timezone(None))
+            ]
+        if not batch:
+            return 0
+
+        dose_ids = [dose["_id"] for dose in batch]
+        now = mongo_precision(datetime.utcnow())
+        result = await self.db.dose_logs.update_many(
+            {"_id": {"$in": dose_ids}, "status": DoseStatus.SCHEDULED},
+            {"$set": {"status": DoseStatus.MISSED, "updated_at": now}}
+        )
+        if result.modified_count < len(batch):
+            # Some were acted on in the meantime; only count the ones marked here
+            marked = {
+                dose["_id"] for dose in await self.db.dose_logs.find(
+                    {"_id": {"$in": dose_ids}, "status": DoseStatus.MISSED, "updated_at": now}, {"_id": 1}
+                ).to_list(None)
+            }
+            batch = [dose for dose in batch if dose["_id"] in marked]
+
+        await self._record_missed(batch, DoseStatus.SCHEDULED)
+        return len(batch)
+
+    async def _sweep_unstored(self, cutoff: datetime) -> int:
+        swept = 0
+        lookback = timedelta(days=MISSED_DOSE_LOOKBACK_DAYS)
+        while True:
+            medications = await self.db.medications.find({"$and": [
+                schedules_in_effect(cutoff - lookback),
+                {"$or": [{"missed_check_at": None}, {"missed_check_at": {"$lte": cutoff}}]}
+            ]}).limit(self.batch_size).to_list(self.batch_size)
+            if not medications:
+                return swept
+
+            zones = await self._user_zones({med["user_id"] for med in medications})
+            windows, candidates, watermarks = [], {}, []
+            for med in medications:
+                # The cutoff on this user's wall clock, which dose times are in
+                zone = zones.get(med["user_id"]) or load_timezone(None)
+                local_cutoff = to_local(cutoff, zone)
+                schedule = CompiledSchedule(MedicationSchedule(**med))
+                swept_until = med.get("missed_swept_until")
+                window_start = max(swept_until, local_cutoff - lookback) if swept_until else local_cutoff - lookback
+                for scheduled_time in schedule.occurrences(window_start, local_cutoff):
+                    if swept_until and scheduled_time <= swept_until:
+                        continue
+                    dose = virtual_dose_document(schedule, scheduled_time)
+                    dose["status"] = DoseStatus.MISSED
+                    candidates[dose_key(med["_id"], scheduled_time)] = dose
+                windows.append({
+                    "user_id": med["user_id"],
+                    "medication_id": med["_id"],
+                    "scheduled_time": {"$gte": window_start, "$lte": local_cutoff}
+                })
+
+                upcoming = next(schedule.occurrences(local_cutoff + timedelta(microseconds=1), local_cutoff + NEXT_CHECK_HORIZON), None)
+                watermarks.append(UpdateOne(
+                    {"_id": med["_id"]},
+                    {"$set": {
+                        "missed_swept_until": local_cutoff,
+                        "missed_check_at": from_local(upcoming or local_cutoff + NEXT_CHECK_HORIZON, zone)
+                    }}
+                ))
+
+            if candidates:
+                # Occurrences already logged under any id keep their state
+                for log in await self.db.dose_logs.find(
+                    {"$or": windows}, {"medication_id": 1, "scheduled_time": 1}
+                ).to_list(None):
+                    candidates.pop(dose_key(log["medication_id"], parse_datetime(log["scheduled_time"])), None)
+            if candidates:
+                inserts = [
+                    UpdateOne(
+                        {"_id": dose["_id"]},
+                        {"$setOnInsert": {key: value for key, value in dose.items() if key != "_id"}},
+                        upsert=True
+                    )
+                    for dose in candidates.values()
+                ]
+                # A log stored since the check above keeps its state; only new documents count
+                result = await self.db.dose_logs.bulk_write(inserts, ordered=False)
+                by_id = {dose["_id"]: dose for dose in candidates.values()}
+                created = [by_id[dose_id] for dose_id in result.upserted_ids.values()]
+                await self._record_missed(created, None)
+                swept += len(created)
+            await self.db.medications.bulk_write(watermarks, ordered=False)
+            if not await self.lease.acquire():
+                return swept
+
+    async def _record_missed(self, doses: List[dict], old_status: Optional[str]):
+        """Move the rollups of doses that just became missed"""
+        increments = status_increments(old_status, DoseStatus.MISSED, stored=0 if old_status else 1)
+        if doses:
+            await self.db.daily_adherence.bulk_write([
+                rollup_update(dose["user_id"], dose["medication_id"], dose["scheduled_time"], increments)
+                for dose in doses
+            ], ordered=False)
+
+    def stats(self) -> dict:
+        return {
+            "running": self._task is not None,
+            "runs": self.runs,
+            "last_run_at": self.last_run_at,
+            "last_swept": self.last_swept,
+            "total_swept": self.total_swept,
+        }
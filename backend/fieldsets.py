@@ -0,0 +1,36 @@
+"""
+Sparse fieldsets for read endpoints
+
+`?fields=name,dosage` limits a response to the listed fields (plus `id`).
+The selection becomes a MongoDB projection, so unrequested fields are not
+read or sent over the wire; see responses.shape_document for how the
+selected fields are serialized.
+"""
+from typing import Optional, Tuple, Type
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+Fields = Tuple[str, ...]
+
+
+def parse_fields(fields: Optional[str], model: Type[BaseModel]) -> Optional[Fields]:
+    """The requested field names, validated against the model; None for all fields"""
+    if not fields:
+        return None
+    requested = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = requested - set(model.model_fields)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(sorted(requested | {"id"}))
+
+
+def projection(fields: Optional[Fields], *required: str) -> Optional[dict]:
+    """Mongo projection for a fieldset; `required` fields are read even if not returned.
+
+    `id` is stored as `_id`, which MongoDB always returns; `id` itself is
+    still read for legacy documents not migrated yet (see migrate_ids.py).
+    """
+    if fields is None:
+        return None
+    return {name: 1 for name in (*fields, *required)}
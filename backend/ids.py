@@ -0,0 +1,58 @@
+"""
+Document ids for Medilog
+
+Ids are ULIDs: 26 Crockford base32 characters encoding a 48-bit millisecond
+timestamp followed by 80 random bits. As plain strings they sort by
+creation time, so the _id index also orders documents newest-first. Ids
+generated within the same millisecond in one process are kept strictly
+increasing by incrementing the random part.
+"""
+import os
+import threading
+import time
+
+CROCKFORD_ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+ID_LENGTH = 26
+
+_TIME_CHARS = 10
+_RANDOM_CHARS = 16
+_RANDOM_BITS = 80
+
+_lock = threading.Lock()
+_last_ms = 0
+_last_random = 0
+
+
+def _encode(value: int, length: int) -> str:
+    chars = []
+    for _ in range(length):
+        value, index = divmod(value, 32)
+        chars.append(CROCKFORD_ALPHABET[index])
+    return "".join(reversed(chars))
+
+
+def format_id(timestamp_ms: int, randomness: int) -> str:
+    """A ULID from its millisecond timestamp and 80-bit random part"""
+    return _encode(timestamp_ms, _TIME_CHARS) + _encode(randomness, _RANDOM_CHARS)
+
+
+def new_id() -> str:
+    """A new, unique id that sorts after every id previously made by this process"""
+    global _last_ms, _last_random
+    with _lock:
+        now_ms = time.time_ns() // 1_000_000
+        if now_ms > _last_ms:
+            _last_ms, _last_random = now_ms, int.from_bytes(os.urandom(10), "big")
+        else:
+            _last_random += 1
+            if _last_random >> _RANDOM_BITS:
+                _last_ms, _last_random = _last_ms + 1, 0
+        return format_id(_last_ms, _last_random)
+
+
+def id_timestamp_ms(value: str) -> int:
+    """Creation time encoded in an id, in milliseconds since the epoch"""
+    timestamp = 0
+    for char in value[:_TIME_CHARS]:
+        timestamp = timestamp * 32 + CROCKFORD_ALPHABET.index(char)
+    return timestamp
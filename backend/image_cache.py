@@ -0,0 +1,133 @@
+"""
+Persistent cache of drug image analysis results
+
+Results are stored in the image_analysis_cache collection, keyed by the
+SHA-256 of the uploaded bytes and also tagged with a 256-bit difference
+hash (dHash) of the picture. An identical upload hits on the SHA-256.
+Near matches, where a re-shot photo's dHash is within
+IMAGE_CACHE_MAX_DISTANCE bits of a cached one, are off by default: boxes of
+the same drug in different strengths (e.g. 100 mg and 300 mg) differ by
+only a few bits, and returning the wrong strength is unsafe.
+The collection is bounded to IMAGE_CACHE_MAX_ENTRIES, evicting the least
+recently used entries.
+"""
+import logging
+import os
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+IMAGE_CACHE_MAX_ENTRIES = int(os.getenv("IMAGE_CACHE_MAX_ENTRIES", "5000"))
+# Hamming distance accepted for near matches; 0 allows exact (SHA-256) hits only
+IMAGE_CACHE_MAX_DISTANCE = int(os.getenv("IMAGE_CACHE_MAX_DISTANCE", "0"))
+
+# dHash grid; produces HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 16
+HASH_BYTES = HASH_SIZE * HASH_SIZE // 8
+
+
+def difference_hash(image: Image.Image) -> bytes:
+    """Perceptual hash of an upright image: brightness gradients on a small grayscale thumbnail"""
+    thumbnail = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE))
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes()
+
+
+class ImageAnalysisCache:
+    """Mongo-backed result cache with an in-memory perceptual hash index"""
+
+    def __init__(self, collection, max_entries: int = IMAGE_CACHE_MAX_ENTRIES,
+                 max_distance: int = IMAGE_CACHE_MAX_DISTANCE):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self._keys = []
+        self._hashes = np.empty((0, HASH_BYTES), dtype=np.uint8)
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def load(self):
+        """Load the perceptual hashes of cached entries into memory"""
+        entries = await self.collection.find(
+            {"phash": {"$ne": None}}, {"_id": 1, "phash": 1}
+        ).limit(self.max_entries).to_list(self.max_entries)
+        self._keys = [entry["_id"] for entry in entries]
+        self._hashes = np.array(
+            [np.frombuffer(bytes.fromhex(entry["phash"]), dtype=np.uint8) for entry in entries],
+            dtype=np.uint8
+        ).reshape(len(entries), HASH_BYTES)
+        logger.info(f"Image analysis cache loaded with {len(entries)} entries")
+
+    def _nearest(self, phash: str) -> Optional[str]:
+        if not self.max_distance or not self._keys:
+            return None
+        query = np.frombuffer(bytes.fromhex(phash), dtype=np.uint8)
+        distances = np.unpackbits(self._hashes ^ query, axis=1).sum(axis=1)
+        best = int(distances.argmin())
+        return self._keys[best] if distances[best] <= self.max_distance else None
+
+    async def lookup(self, digest: str, phash: Optional[str]) -> Optional[dict]:
+        """Cached drug_info for an image, or None"""
+        entry = await self.collection.find_one({"_id": digest}, {"drug_info": 1})
+        if entry is None and phash:
+            near_key = self._nearest(phash)
+            if near_key:
+                entry = await self.collection.find_one({"_id": near_key}, {"drug_info": 1})
+                if entry:
+                    self.near_hits += 1
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        await self.collection.update_one(
+            {"_id": entry["_id"]},
+            {"$set": {"last_used_at": datetime.utcnow()}, "$inc": {"hits": 1}}
+        )
+        return entry["drug_info"]
+
+    async def store(self, digest: str, phash: Optional[str], drug_info: dict):
+        """Cache a successful analysis and evict the least recently used overflow"""
+        now = datetime.utcnow()
+        await self.collection.update_one(
+            {"_id": digest},
+            {
+                "$set": {"phash": phash, "drug_info": drug_info, "last_used_at": now},
+                "$setOnInsert": {"created_at": now, "hits": 0}
+            },
+            upsert=True
+        )
+        if phash and digest not in self._keys:
+            self._keys.append(digest)
+            self._hashes = np.vstack([self._hashes, np.frombuffer(bytes.fromhex(phash), dtype=np.uint8)])
+        await self._evict()
+
+    async def _evict(self):
+        overflow = await self.collection.estimated_document_count() - self.max_entries
+        if overflow <= 0:
+            return
+        stale = await self.collection.find({}, {"_id": 1}).sort("last_used_at", 1).limit(overflow).to_list(overflow)
+        stale_keys = {entry["_id"] for entry in stale}
+        await self.collection.delete_many({"_id": {"$in": list(stale_keys)}})
+        self.evictions += len(stale_keys)
+
+        keep = [i for i, key in enumerate(self._keys) if key not in stale_keys]
+        self._keys = [self._keys[i] for i in keep]
+        self._hashes = self._hashes[keep]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._keys),
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,146 @@
+"""
+Upload preprocessing for drug image analysis
+
+Uploads are read in chunks up to MAX_UPLOAD_BYTES, then decoded,
+auto-oriented from EXIF, downsampled so the long edge is at most
+MAX_IMAGE_DIMENSION (the largest size the vision model uses without
+rescaling) and re-encoded as JPEG. Decoding and encoding run in a
+dedicated thread pool so large photos do not stall the event loop.
+"""
+import asyncio
+import hashlib
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+from fastapi import HTTPException, UploadFile, status
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from image_cache import difference_hash
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+MAX_IMAGE_DIMENSION = int(os.getenv("MAX_IMAGE_DIMENSION", "1568"))
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", "85"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_MAX_PENDING = int(os.getenv("IMAGE_MAX_PENDING", "32"))
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Refuse decompression bombs well before they allocate
+Image.MAX_IMAGE_PIXELS = 50_000_000
+
+
+class PreparedImage(NamedTuple):
+    data: bytes
+    media_type: str
+    digest: str
+    phash: str
+    original_bytes: int
+
+
+async def read_upload(file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES) -> bytes:
+    """Read an upload in chunks, rejecting it with 413 once it exceeds max_bytes"""
+    chunks = []
+    size = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Image exceeds {max_bytes // (1024 * 1024)} MB"
+            )
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def prepare_image(contents: bytes) -> PreparedImage:
+    """Decode, orient, downsample and re-encode an uploaded image"""
+    try:
+        with Image.open(io.BytesIO(contents)) as image:
+            image = ImageOps.exif_transpose(image)
+            if image.mode in ("RGBA", "LA", "P"):
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, "white")
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+            image.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION), Image.LANCZOS)
+
+            output = io.BytesIO()
+            image.save(output, "JPEG", quality=JPEG_QUALITY, optimize=True)
+            phash = difference_hash(image).hex()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid image file")
+
+    return PreparedImage(
+        data=output.getvalue(),
+        media_type="image/jpeg",
+        digest=hashlib.sha256(contents).hexdigest(),
+        phash=phash,
+        original_bytes=len(contents),
+    )
+
+
+class ImageProcessor:
+    """Runs prepare_image in a size-limited thread pool; 503 when saturated.
+
+    Background work (batch jobs) passes wait=True to queue for the pool
+    instead: such callers wait for one of `workers` slots and are never
+    refused, so a batch cannot fail just because the pool is busy.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image")
+        self._background_slots = asyncio.Semaphore(workers)
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._total_seconds = 0.0
+
+    async def prepare(self, contents: bytes, wait: bool = False) -> PreparedImage:
+        if wait:
+            async with self._background_slots:
+                return await self._prepare(contents)
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server busy, please retry",
+                headers={"Retry-After": "1"},
+            )
+        return await self._prepare(contents)
+
+    async def _prepare(self, contents: bytes) -> PreparedImage:
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            prepared = await asyncio.get_running_loop().run_in_executor(self._executor, prepare_image, contents)
+        finally:
+            self.pending -= 1
+            self._total_seconds += time.perf_counter() - started
+        self.completed += 1
+        self.bytes_in += prepared.original_bytes
+        self.bytes_out += len(prepared.data)
+        return prepared
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "avg_latency_ms": round(self._total_seconds / self.completed * 1000, 2) if self.completed else 0.0,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+image_processor = ImageProcessor(IMAGE_WORKERS, IMAGE_MAX_PENDING)
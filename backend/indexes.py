@@ -0,0 +1,164 @@
+"""
+MongoDB index declarations for Medilog
+
+Indexes are created at application startup, after dropping the ones that
+were replaced. To create or verify them against a deployment by hand:
+
+    python indexes.py           # create missing indexes
+    python indexes.py --check   # exit with status 1 if any index is missing
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "drugs": [
+        IndexModel([("category", ASCENDING), ("_id", ASCENDING)], name="category_pk"),
+    ],
+    "medications": [
+        IndexModel(
+            [("user_id", ASCENDING), ("active", ASCENDING), ("_id", DESCENDING)],
+            name="user_active_pk"
+        ),
+        IndexModel([("active", ASCENDING), ("missed_check_at", ASCENDING)], name="active_missed_check"),
+        IndexModel(
+            [("active", ASCENDING), ("reminder_enabled", ASCENDING), ("next_reminder_at", ASCENDING)],
+            name="active_next_reminder"
+        ),
+    ],
+    "dose_logs": [
+        IndexModel(
+            [("user_id", ASCENDING), ("scheduled_time", DESCENDING), ("_id", DESCENDING)],
+            name="user_scheduled_pk"
+        ),
+        IndexModel(
+            [("user_id", ASCENDING), ("medication_id", ASCENDING), ("scheduled_time", DESCENDING), ("_id", DESCENDING)],
+            name="user_medication_scheduled_pk"
+        ),
+        # Only SCHEDULED logs, for the missed dose sweeper
+        IndexModel(
+            [("scheduled_time", ASCENDING)],
+            name="scheduled_pending",
+            partialFilterExpression={"status": "scheduled"}
+        ),
+    ],
+    "daily_adherence": [
+        IndexModel(
+            [("user_id", ASCENDING), ("date", ASCENDING), ("medication_id", ASCENDING)],
+            name="user_date_medication_unique",
+            unique=True
+        ),
+    ],
+    "analysis_jobs": [
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "image_analysis_cache": [
+        IndexModel([("last_used_at", ASCENDING)], name="last_used"),
+    ],
+}
+
+# Indexes replaced since ids became the documents' _id. `id_unique` must go
+# before new documents are written: they have no `id` field, so a second
+# insert would collide on null.
+OBSOLETE_INDEXES: Dict[str, List[str]] = {
+    "users": ["id_unique"],
+    "drugs": ["id_unique", "category", "created_id"],
+    "medications": ["id_unique", "user_active_created_id", "active_reminders"],
+    "dose_logs": ["id_unique", "user_scheduled_id", "user_medication_scheduled_id"],
+    "analysis_jobs": ["id_unique"],
+}
+
+
+async def drop_obsolete_indexes(db) -> List[str]:
+    """Drop replaced indexes that still exist; returns their names"""
+    dropped = []
+    for collection, names in OBSOLETE_INDEXES.items():
+        existing = await db[collection].index_information()
+        for name in names:
+            if name in existing:
+                await db[collection].drop_index(name)
+                dropped.append(f"{collection}.{name}")
+                logger.info(f"Dropped obsolete index {collection}.{name}")
+    return dropped
+
+
+async def ensure_indexes(db) -> Dict[str, Dict[str, str]]:
+    """Create every declared index and log the outcome per index.
+
+    A failing index (e.g. a unique index over existing duplicates) is logged
+    and skipped so the application can still start.
+    """
+    try:
+        await drop_obsolete_indexes(db)
+    except PyMongoError as e:
+        logger.error(f"Obsolete indexes could not be dropped: {e}")
+
+    status: Dict[str, Dict[str, str]] = {}
+    for collection, models in INDEXES.items():
+        status[collection] = {}
+        for model in models:
+            name = model.document["name"]
+            try:
+                await db[collection].create_indexes([model])
+                status[collection][name] = "ready"
+            except PyMongoError as e:
+                status[collection][name] = f"failed: {e}"
+                logger.error(f"Index {collection}.{name} could not be built: {e}")
+        ready = sum(1 for s in status[collection].values() if s == "ready")
+        logger.info(f"Indexes on {collection}: {ready}/{len(models)} ready")
+    return status
+
+
+async def missing_indexes(db) -> List[str]:
+    """Declared indexes that do not exist (or differ in keys) on the server"""
+    missing = []
+    for collection, models in INDEXES.items():
+        existing = await db[collection].index_information()
+        for model in models:
+            name = model.document["name"]
+            keys = list(model.document["key"].items())
+            if name not in existing or list(existing[name]["key"]) != keys:
+                missing.append(f"{collection}.{name}")
+    return missing
+
+
+async def main(check: bool) -> int:
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        if not check:
+            await ensure_indexes(db)
+        missing = await missing_indexes(db)
+    finally:
+        client.close()
+
+    if missing:
+        print("✗ Missing indexes:")
+        for name in missing:
+            print(f"  - {name}")
+        return 1
+    print(f"✓ All {sum(len(models) for models in INDEXES.values())} indexes present")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Create or verify MongoDB indexes")
+    parser.add_argument("--check", action="store_true", help="only verify, do not create")
+    sys.exit(asyncio.run(main(parser.parse_args().check)))
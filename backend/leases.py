@@ -0,0 +1,41 @@
+"""
+Leases for background work shared by several workers
+
+A lease is a document in the leases collection naming its owner and when
+it expires. A worker holds it until it expires or is released; renewing
+it before then keeps it. Taking a lease is a single upsert that matches
+only a free or own lease, so two workers can never both succeed.
+"""
+import os
+import socket
+from datetime import datetime, timedelta
+
+from pymongo.errors import DuplicateKeyError
+
+from ids import new_id
+
+
+class Lease:
+    """A named lock held by this process for `duration` seconds at a time"""
+
+    def __init__(self, collection, name: str, duration: float):
+        self.collection = collection
+        self.name = name
+        self.duration = duration
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{new_id()}"
+
+    async def acquire(self) -> bool:
+        """Take or renew the lease; False while another worker holds it"""
+        now = datetime.utcnow()
+        try:
+            await self.collection.update_one(
+                {"_id": self.name, "$or": [{"owner": self.owner}, {"expires_at": {"$lte": now}}]},
+                {"$set": {"owner": self.owner, "expires_at": now + timedelta(seconds=self.duration)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def release(self):
+        await self.collection.delete_one({"_id": self.name, "owner": self.owner})
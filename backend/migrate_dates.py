@@ -0,0 +1,148 @@
+"""
+Convert timestamps stored as ISO strings into native BSON dates
+
+Documents are rewritten in batches ordered by _id. After each batch the
+last _id is checkpointed in the migrations collection, so an interrupted
+run resumes where it stopped; the checkpoint is cleared once a collection
+has been scanned to the end, so the next run starts over. Each update is
+guarded on the old string value, so a document changed by the application
+in the meantime is left alone. The run is idempotent: deploy the new code,
+run the migration, and run it again to pick up any strings written by old
+instances during the rollout.
+
+    python migrate_dates.py                  # migrate every collection
+    python migrate_dates.py --check          # exit with status 1 if strings remain
+    python migrate_dates.py --restart        # ignore checkpoints and rescan
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Tuple
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+from dates import parse_datetime
+
+logger = logging.getLogger(__name__)
+
+DATE_FIELDS: Dict[str, Tuple[str, ...]] = {
+    "users": ("created_at", "updated_at"),
+    "drugs": ("created_at", "updated_at"),
+    "medications": ("start_date", "end_date", "created_at", "updated_at"),
+    "dose_logs": ("scheduled_time", "actual_time", "created_at", "updated_at"),
+    "daily_adherence": ("updated_at",),
+    "image_analysis_cache": ("created_at", "last_used_at"),
+    "analysis_jobs": ("created_at",),
+}
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def _string_filter(fields: Tuple[str, ...]) -> dict:
+    return {"$or": [{field: {"$type": "string"}} for field in fields]}
+
+
+def _conversion(doc: dict, fields: Tuple[str, ...]):
+    """UpdateOne replacing the document's string timestamps, or None"""
+    old, new = {}, {}
+    for field in fields:
+        value = doc.get(field)
+        if not isinstance(value, str):
+            continue
+        try:
+            new[field] = parse_datetime(value)
+        except ValueError:
+            logger.warning(f"Unparseable {field} {value!r} on _id {doc['_id']}, left as is")
+            continue
+        old[field] = value
+    if not new:
+        return None
+    return UpdateOne({"_id": doc["_id"], **old}, {"$set": new})
+
+
+async def migrate_collection(db, name: str, batch_size: int = DEFAULT_BATCH_SIZE,
+                             restart: bool = False, pause: float = 0.0) -> int:
+    """Convert one collection; returns the number of documents updated in this run"""
+    fields = DATE_FIELDS[name]
+    checkpoint_id = f"bson_dates:{name}"
+    checkpoint = None if restart else await db.migrations.find_one({"_id": checkpoint_id})
+    last_id = checkpoint["last_id"] if checkpoint else None
+
+    converted = 0
+    while True:
+        query = _string_filter(fields)
+        if last_id is not None:
+            query = {"$and": [query, {"_id": {"$gt": last_id}}]}
+        batch = await db[name].find(query, {field: 1 for field in fields}) \
+            .sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        operations = [op for op in (_conversion(doc, fields) for doc in batch) if op is not None]
+        modified = 0
+        if operations:
+            modified = (await db[name].bulk_write(operations, ordered=False)).modified_count
+            converted += modified
+        last_id = batch[-1]["_id"]
+        await db.migrations.update_one(
+            {"_id": checkpoint_id},
+            {"$set": {"last_id": last_id, "updated_at": datetime.utcnow()}, "$inc": {"converted": modified}},
+            upsert=True
+        )
+        logger.info(f"{name}: {converted} documents converted so far")
+        if pause:
+            await asyncio.sleep(pause)
+
+    # A complete pass: the next run rescans, since old instances may have
+    # written strings to documents before the checkpoint
+    await db.migrations.delete_one({"_id": checkpoint_id})
+    logger.info(f"{name}: done, {converted} documents converted")
+    return converted
+
+
+async def remaining_strings(db) -> Dict[str, int]:
+    """Number of documents per collection still holding string timestamps"""
+    counts = {}
+    for name, fields in DATE_FIELDS.items():
+        count = await db[name].count_documents(_string_filter(fields))
+        if count:
+            counts[name] = count
+    return counts
+
+
+async def main(check: bool, restart: bool, batch_size: int, pause: float) -> int:
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        if not check:
+            for name in DATE_FIELDS:
+                await migrate_collection(db, name, batch_size, restart, pause)
+        remaining = await remaining_strings(db)
+    finally:
+        client.close()
+
+    if remaining:
+        print("✗ Documents with string timestamps:")
+        for name, count in remaining.items():
+            print(f"  - {name}: {count}")
+        return 1
+    print("✓ All timestamps are BSON dates")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Convert ISO string timestamps to BSON dates")
+    parser.add_argument("--check", action="store_true", help="only report remaining strings")
+    parser.add_argument("--restart", action="store_true", help="ignore checkpoints and rescan from the start")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.check, args.restart, args.batch_size, args.pause)))
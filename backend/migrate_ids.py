@@ -0,0 +1,208 @@
+"""
+Move documents from legacy `id` strings to ULID `_id` keys
+
+Documents used to carry an `id` made from the creation timestamp as a float
+string ("1735718400.123456") next to MongoDB's ObjectId `_id`. Each such
+document is copied under a ULID `_id` derived deterministically from the
+legacy id (same millisecond, random part taken from a hash of it), with
+its references (user_id, drug_id, medication_id) converted the same way,
+and the original is deleted. Materialized virtual dose ids
+("<medication id>@<time>") keep their form with the medication part
+converted. Rollups, and documents the new code wrote for a legacy user or
+medication before it was moved, have their references converted in place.
+
+Because the conversion is deterministic, documents can be processed in any
+order and an interrupted run simply continues. The new code looks documents
+up by `_id`, so legacy documents are not found by it: run this before the
+new code serves traffic (e.g. as a release step), and once more after the
+old instances are gone to pick up what they wrote during the rollout:
+
+    python migrate_ids.py                 # migrate every collection
+    python migrate_ids.py --check         # exit with status 1 if legacy ids remain
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import sys
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from ids import CROCKFORD_ALPHABET, ID_LENGTH, format_id
+from indexes import drop_obsolete_indexes
+
+logger = logging.getLogger(__name__)
+
+REFERENCES: Dict[str, Tuple[str, ...]] = {
+    "users": (),
+    "drugs": (),
+    "medications": ("user_id", "drug_id"),
+    "dose_logs": ("user_id", "medication_id"),
+    "analysis_jobs": ("user_id",),
+}
+
+LEGACY_ID_PATTERN = r"^\d+(\.\d+)?(@|$)"
+LEGACY_FILTER = {"id": {"$exists": True}}
+ROLLUP_REFERENCES = ("user_id", "medication_id")
+
+
+def legacy_reference_filter(references: Tuple[str, ...]) -> dict:
+    """Documents with a reference still holding a legacy id"""
+    return {"$or": [{field: {"$regex": LEGACY_ID_PATTERN}} for field in references]}
+
+
+LEGACY_ROLLUP_FILTER = legacy_reference_filter(ROLLUP_REFERENCES)
+
+DEFAULT_BATCH_SIZE = 500
+DUPLICATE_KEY = 11000
+
+
+def is_new_id(value: str) -> bool:
+    return len(value) == ID_LENGTH and all(char in CROCKFORD_ALPHABET for char in value)
+
+
+def convert_id(value: Optional[str]) -> Optional[str]:
+    """The ULID for a legacy id; new ids and None are returned unchanged"""
+    if value is None or is_new_id(value):
+        return value
+    prefix, sep, stamp = value.partition("@")
+    if sep:
+        return f"{convert_id(prefix)}@{stamp}"
+    if not re.fullmatch(LEGACY_ID_PATTERN, value):
+        raise ValueError(f"Unrecognized id {value!r}")
+    randomness = int.from_bytes(hashlib.sha256(value.encode()).digest()[:10], "big")
+    return format_id(round(float(value) * 1000), randomness)
+
+
+def converted_document(doc: dict, references: Tuple[str, ...]) -> dict:
+    """A legacy document as it is stored now: keyed by the converted id"""
+    new = {key: value for key, value in doc.items() if key not in ("_id", "id")}
+    new["_id"] = convert_id(doc["id"])
+    for field in references:
+        if field in new:
+            new[field] = convert_id(new[field])
+    return new
+
+
+async def migrate_collection(db, name: str, batch_size: int = DEFAULT_BATCH_SIZE, pause: float = 0.0) -> int:
+    """Move one collection's legacy documents; returns the number moved"""
+    references = REFERENCES[name]
+    moved = 0
+    skip = []
+    while True:
+        query = {**LEGACY_FILTER, "_id": {"$nin": skip}} if skip else LEGACY_FILTER
+        batch = await db[name].find(query).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not batch:
+            break
+
+        copies, originals = [], []
+        for doc in batch:
+            try:
+                copies.append(converted_document(doc, references))
+                originals.append(doc["_id"])
+            except (ValueError, TypeError) as e:
+                logger.warning(f"{name}: _id {doc['_id']} left as is: {e}")
+                skip.append(doc["_id"])
+
+        if copies:
+            try:
+                await db[name].insert_many(copies, ordered=False)
+            except BulkWriteError as e:
+                # Copies left by an interrupted run already exist
+                if any(error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]):
+                    raise
+            await db[name].delete_many({"_id": {"$in": originals}})
+            moved += len(originals)
+        logger.info(f"{name}: {moved} documents moved so far")
+        if pause:
+            await asyncio.sleep(pause)
+
+    logger.info(f"{name}: done, {moved} documents moved")
+    return moved
+
+
+async def migrate_references(db, name: str, references: Tuple[str, ...], batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """Convert legacy references in place on documents already keyed by ULID.
+
+    Besides rollups, these are documents the new code wrote for a legacy
+    user or medication before its migration.
+    """
+    query = {**legacy_reference_filter(references), "id": {"$exists": False}}
+    rekeyed = 0
+    while True:
+        rows = await db[name].find(query, {field: 1 for field in references}) \
+            .limit(batch_size).to_list(batch_size)
+        if not rows:
+            break
+        result = await db[name].bulk_write([
+            UpdateOne({"_id": row["_id"]}, {"$set": {
+                field: convert_id(row[field]) for field in references
+                if isinstance(row.get(field), str) and re.match(LEGACY_ID_PATTERN, row[field])
+            }})
+            for row in rows
+        ], ordered=False)
+        rekeyed += result.modified_count
+    logger.info(f"{name}: done, {rekeyed} documents with legacy references converted")
+    return rekeyed
+
+
+async def migrate_rollups(db, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """Rekey daily adherence rollups to the converted user and medication ids"""
+    return await migrate_references(db, "daily_adherence", ROLLUP_REFERENCES, batch_size)
+
+
+async def remaining_legacy(db) -> Dict[str, int]:
+    """Number of documents per collection still keyed by a legacy id"""
+    counts = {}
+    for name, references in REFERENCES.items():
+        query = {"$or": [LEGACY_FILTER, legacy_reference_filter(references)]} if references else LEGACY_FILTER
+        count = await db[name].count_documents(query)
+        if count:
+            counts[name] = count
+    count = await db.daily_adherence.count_documents(LEGACY_ROLLUP_FILTER)
+    if count:
+        counts["daily_adherence"] = count
+    return counts
+
+
+async def main(check: bool, batch_size: int, pause: float) -> int:
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        if not check:
+            # Copies have no `id`, so the old unique index on it has to go first
+            await drop_obsolete_indexes(db)
+            for name, references in REFERENCES.items():
+                await migrate_collection(db, name, batch_size, pause)
+                if references:
+                    await migrate_references(db, name, references, batch_size)
+            await migrate_rollups(db, batch_size)
+        remaining = await remaining_legacy(db)
+    finally:
+        client.close()
+
+    if remaining:
+        print("✗ Documents with legacy ids:")
+        for name, count in remaining.items():
+            print(f"  - {name}: {count}")
+        return 1
+    print("✓ All documents are keyed by ULID _id")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Move documents from legacy id strings to ULID _id keys")
+    parser.add_argument("--check", action="store_true", help="only report remaining legacy ids")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args.check, args.batch_size, args.pause)))
@@ -1,8 +1,10 @@
-from pydantic import BaseModel, Field, EmailStr
+from pydantic import AliasChoices, BaseModel, Field, EmailStr
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 from enum import Enum
 
+from ids import new_id
+
 
 class DosageForm(str, Enum):
     TABLET = "tablet"
@@ -21,6 +23,13 @@ class DoseStatus(str, Enum):
     SKIPPED = "skipped"
 
 
+class AnalysisJobStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"  # the worker running it stopped before finishing
+
+
 class FrequencyType(str, Enum):
     DAILY = "daily"
     TWICE_DAILY = "twice_daily"
@@ -33,7 +42,7 @@ class FrequencyType(str, Enum):
 
 # User Model
 class User(BaseModel):
-    id: str = Field(default_factory=lambda: str(datetime.now().timestamp()))
+    id: str = Field(default_factory=new_id, validation_alias=AliasChoices("id", "_id"))
     email: EmailStr
     full_name: str
     hashed_password: str
@@ -56,6 +65,7 @@ class UserLogin(BaseModel):
 class PushTokenCreate(BaseModel):
     token: str
     device_type: str = "mobile"
+    timezone: Optional[str] = None  # IANA name of the device's timezone, e.g. "Europe/Istanbul"
 
 
 class Token(BaseModel):
@@ -83,7 +93,7 @@ class Pharmacokinetics(BaseModel):
 
 # Drug Model
 class Drug(BaseModel):
-    id: str = Field(default_factory=lambda: str(datetime.now().timestamp()))
+    id: str = Field(default_factory=new_id, validation_alias=AliasChoices("id", "_id"))
     name: str
     active_ingredient: str
     description: Optional[str] = None
@@ -113,9 +123,38 @@ class DrugCreate(BaseModel):
     category: Optional[str] = None
 
 
+# Concentration Curve Models
+class ConcentrationCurve(BaseModel):
+    dose: float  # amount per dose, e.g. 10 for "10mg"
+    peak_concentration: float
+    peak_time: float  # hours
+    concentrations: List[float] = []  # one value per entry in `times`
+
+
+class ConcentrationProfile(BaseModel):
+    drug_id: str
+    drug_name: str
+    absorption_rate: float  # ka (1/h)
+    elimination_rate: float  # ke (1/h)
+    times: List[float] = []  # hours after the dose
+    curves: List[ConcentrationCurve] = []
+
+
 # Medication Schedule Model
+class ScheduleRevision(BaseModel):
+    """An earlier version of a medication's schedule, in effect from effective_from
+    (None: the start date) until the next revision or schedule_changed_at"""
+    effective_from: Optional[datetime] = None
+    dosage: str
+    frequency: FrequencyType
+    custom_frequency: Optional[str] = None
+    specific_times: List[str] = []
+    end_date: Optional[datetime] = None
+    active: bool = True
+
+
 class MedicationSchedule(BaseModel):
-    id: str = Field(default_factory=lambda: str(datetime.now().timestamp()))
+    id: str = Field(default_factory=new_id, validation_alias=AliasChoices("id", "_id"))
     user_id: str
     drug_id: str
     drug_name: str  # Denormalized for quick access
@@ -133,6 +172,10 @@ class MedicationSchedule(BaseModel):
     reminder_enabled: bool = True
     reminder_minutes_before: int = 15
     active: bool = True
+    # The schedule above is in effect from schedule_changed_at (or the start
+    # date); earlier doses follow schedule_history
+    schedule_changed_at: Optional[datetime] = None
+    schedule_history: List[ScheduleRevision] = []
     created_at: datetime = Field(default_factory=datetime.utcnow)
     updated_at: datetime = Field(default_factory=datetime.utcnow)
 
@@ -167,7 +210,7 @@ class MedicationScheduleUpdate(BaseModel):
 
 # Dose Log Model
 class DoseLog(BaseModel):
-    id: str = Field(default_factory=lambda: str(datetime.now().timestamp()))
+    id: str = Field(default_factory=new_id, validation_alias=AliasChoices("id", "_id"))
     user_id: str
     medication_id: str
     drug_name: str  # Denormalized
@@ -196,6 +239,68 @@ class DoseLogUpdate(BaseModel):
     side_effects_reported: Optional[List[str]] = None
 
 
+class DoseBulkItem(BaseModel):
+    id: str
+    status: DoseStatus
+    actual_time: Optional[datetime] = None  # defaults to now for taken doses
+    notes: Optional[str] = None
+
+
+class DoseBulkUpdate(BaseModel):
+    doses: List[DoseBulkItem]
+
+
+class DoseBulkResult(BaseModel):
+    id: str
+    success: bool
+    status: Optional[DoseStatus] = None
+    message: Optional[str] = None
+
+
+class DoseBulkResponse(BaseModel):
+    updated: int = 0
+    results: List[DoseBulkResult] = []
+
+
+# Plasma Level Models
+class PlasmaLevelSeries(BaseModel):
+    medication_id: str
+    drug_id: str
+    drug_name: str
+    dosage: str
+    current_level: float = 0.0  # estimated level right now
+    levels: List[float] = []  # one value per entry in `times`
+
+
+class PlasmaLevelTimeline(BaseModel):
+    start: datetime
+    end: datetime
+    resolution: float  # hours between samples
+    times: List[float] = []  # hours after `start`
+    medications: List[PlasmaLevelSeries] = []
+
+
+# Batch Image Analysis Models
+class ImageAnalysisResult(BaseModel):
+    index: int  # position of the image in the upload
+    filename: Optional[str] = None
+    status: str = "pending"  # pending, success, failed
+    data: Optional[Dict[str, Any]] = None
+    message: Optional[str] = None
+
+
+class AnalysisJob(BaseModel):
+    id: str = Field(default_factory=new_id, validation_alias=AliasChoices("id", "_id"))
+    user_id: str
+    status: AnalysisJobStatus = AnalysisJobStatus.PENDING
+    total: int
+    completed: int = 0
+    results: List[ImageAnalysisResult] = []
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    heartbeat_at: Optional[datetime] = None  # renewed while a worker runs the job
+    expires_at: datetime
+
+
 # Progress Tracking Model
 class ProgressStats(BaseModel):
     total_doses_scheduled: int = 0
@@ -205,6 +310,7 @@ class ProgressStats(BaseModel):
     adherence_rate: float = 0.0  # percentage
     current_streak: int = 0  # consecutive days
     longest_streak: int = 0
+    last_perfect_date: Optional[str] = None  # YYYY-MM-DD
     total_active_medications: int = 0
 
 
@@ -217,7 +323,7 @@ class DailyAdherence(BaseModel):
 
 
 class ProgressTracking(BaseModel):
-    id: str = Field(default_factory=lambda: str(datetime.now().timestamp()))
+    id: str = Field(default_factory=new_id, validation_alias=AliasChoices("id", "_id"))
     user_id: str
     period_start: datetime
     period_end: datetime
@@ -0,0 +1,136 @@
+"""
+Keyset pagination and NDJSON streaming for list endpoints
+
+Pages are ordered by a sort field plus `_id` as a tie-breaker, or by `_id`
+alone, which orders documents by creation. The opaque cursor encodes the
+(sort value, _id) of the last item on a page, and the next page is the
+query for items strictly after it, so every page is one indexed range
+scan regardless of how deep the client has paged.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Any, AsyncIterator, List, Optional, Tuple, Type
+
+import orjson
+from fastapi import HTTPException
+from pydantic import BaseModel
+from pymongo import DESCENDING
+
+from fieldsets import Fields
+from responses import shape_document
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Requests with neither limit nor cursor get what the lists returned before paging
+UNPAGED_PAGE_SIZE = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def page_size(limit: Optional[int], cursor: Optional[str]) -> int:
+    """The page size of a list request.
+
+    Clients that page without a limit get DEFAULT_PAGE_SIZE; clients that
+    don't page at all (the app's home and doses screens) keep getting up to
+    UNPAGED_PAGE_SIZE items.
+    """
+    if limit is not None:
+        return limit
+    return DEFAULT_PAGE_SIZE if cursor else UNPAGED_PAGE_SIZE
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    return value
+
+
+def _decode_value(value: Any) -> Any:
+    if isinstance(value, dict) and "$date" in value:
+        return datetime.fromisoformat(value["$date"])
+    return value
+
+
+def encode_cursor(sort_value: Any, item_id: str) -> str:
+    payload = json.dumps([_encode_value(sort_value), item_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, str]:
+    """(sort value, id) of a cursor; 400 if it was not produced by encode_cursor"""
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, item_id = json.loads(payload)
+        return _decode_value(sort_value), str(item_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_query(query: dict, sort_field: str, direction: int, cursor: Optional[str]) -> dict:
+    """The query restricted to items after the cursor in (sort_field, _id) order"""
+    if not cursor:
+        return query
+    sort_value, item_id = decode_cursor(cursor)
+    after = "$lt" if direction == DESCENDING else "$gt"
+    if sort_field == "_id":
+        return {"$and": [query, {"_id": {after: item_id}}]}
+    return {
+        "$and": [
+            query,
+            {"$or": [
+                {sort_field: {after: sort_value}},
+                {sort_field: sort_value, "_id": {after: item_id}},
+            ]},
+        ]
+    }
+
+
+def keyset_sort(sort_field: str, direction: int) -> List[Tuple[str, int]]:
+    if sort_field == "_id":
+        return [("_id", direction)]
+    return [(sort_field, direction), ("_id", direction)]
+
+
+async def fetch_page(
+    collection,
+    query: dict,
+    sort_field: str,
+    direction: int = DESCENDING,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    projection: Optional[dict] = None,
+) -> Tuple[List[dict], Optional[str]]:
+    """One page of documents and the cursor of the next page (None on the last page)"""
+    docs = await collection.find(
+        keyset_query(query, sort_field, direction, cursor), projection
+    ).sort(keyset_sort(sort_field, direction)).limit(limit + 1).to_list(limit + 1)
+
+    if len(docs) <= limit:
+        return docs, None
+    docs = docs[:limit]
+    return docs, encode_cursor(docs[-1][sort_field], docs[-1]["_id"])
+
+
+def find_all(
+    collection,
+    query: dict,
+    sort_field: str,
+    direction: int = DESCENDING,
+    cursor: Optional[str] = None,
+    projection: Optional[dict] = None,
+):
+    """A Motor cursor over every document after the cursor, for streaming"""
+    return collection.find(
+        keyset_query(query, sort_field, direction, cursor), projection
+    ).sort(keyset_sort(sort_field, direction))
+
+
+async def ndjson_lines(
+    docs: AsyncIterator[dict],
+    model: Type[BaseModel],
+    fields: Optional[Fields] = None
+) -> AsyncIterator[bytes]:
+    """Serialize documents shaped like `model` one per line as they arrive"""
+    async for doc in docs:
+        yield orjson.dumps(shape_document(doc, model, fields)) + b"\n"
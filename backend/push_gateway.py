@@ -0,0 +1,112 @@
+"""
+Push notification gateway client for Medilog
+
+Reminders are delivered through the Expo push service, which issues the
+app's push tokens (ExponentPushToken[...]). One ExpoPushGateway is created
+at application startup; it sends batches of up to 100 messages, the most
+Expo accepts per request, over a single pooled httpx client.
+PUSH_BACKEND=stub swaps in a local gateway that records messages, for tests
+and offline development.
+"""
+import asyncio
+import logging
+import os
+from typing import List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+PUSH_BACKEND = os.getenv("PUSH_BACKEND", "expo")
+EXPO_PUSH_URL = os.getenv("EXPO_PUSH_URL", "https://exp.host/--/api/v2/push/send")
+PUSH_TIMEOUT_SECONDS = float(os.getenv("PUSH_TIMEOUT_SECONDS", "10"))
+PUSH_MAX_CONNECTIONS = int(os.getenv("PUSH_MAX_CONNECTIONS", "8"))
+PUSH_STUB_LATENCY_SECONDS = float(os.getenv("PUSH_STUB_LATENCY_SECONDS", "0"))
+
+MAX_MESSAGES_PER_REQUEST = 100
+
+
+class PushGatewayError(Exception):
+    """A batch the gateway did not accept"""
+
+    def __init__(self, message: str, retryable: bool = True, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    try:
+        return float(response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+class ExpoPushGateway:
+    """Expo push API through one pooled AsyncClient"""
+
+    def __init__(self, url: str = EXPO_PUSH_URL, access_token: Optional[str] = None):
+        self.url = url
+        headers = {"Accept": "application/json", "Accept-Encoding": "gzip, deflate"}
+        if access_token:
+            headers["Authorization"] = f"Bearer {access_token}"
+        self.client = httpx.AsyncClient(
+            headers=headers,
+            timeout=PUSH_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=PUSH_MAX_CONNECTIONS),
+        )
+
+    async def send(self, messages: List[dict]) -> List[str]:
+        """Deliver one batch; returns the tokens Expo reports as no longer registered"""
+        try:
+            response = await self.client.post(self.url, json=messages)
+        except httpx.HTTPError as e:
+            raise PushGatewayError(f"Push gateway request failed: {e!r}")
+        if response.status_code == 429 or response.status_code >= 500:
+            raise PushGatewayError(f"Push gateway returned {response.status_code}", retry_after=_retry_after(response))
+        if response.status_code >= 400:
+            raise PushGatewayError(f"Push gateway rejected the batch: {response.text[:200]}", retryable=False)
+
+        unregistered = []
+        for message, ticket in zip(messages, response.json().get("data", [])):
+            if ticket.get("status") != "error":
+                continue
+            if ticket.get("details", {}).get("error") == "DeviceNotRegistered":
+                unregistered.append(message["to"])
+            else:
+                logger.warning(f"Push to {message['to']} failed: {ticket.get('message')}")
+        return unregistered
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class StubPushGateway:
+    """Records messages instead of sending them, for tests and running offline"""
+
+    def __init__(self, latency: float = PUSH_STUB_LATENCY_SECONDS, failures: int = 0):
+        self.latency = latency
+        # The next `failures` batches are refused, to exercise retries
+        self.failures = failures
+        self.sent: List[dict] = []
+        self.requests = 0
+
+    async def send(self, messages: List[dict]) -> List[str]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.requests += 1
+        if self.failures:
+            self.failures -= 1
+            raise PushGatewayError("Stub push gateway unavailable")
+        self.sent.extend(messages)
+        return []
+
+    async def close(self):
+        pass
+
+
+def create_push_gateway():
+    """Build the gateway for the configured backend"""
+    if PUSH_BACKEND == "stub":
+        return StubPushGateway()
+    return ExpoPushGateway(access_token=os.getenv("EXPO_ACCESS_TOKEN"))
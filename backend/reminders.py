@@ -0,0 +1,263 @@
+"""
+Server-side medication reminders
+
+One worker (holding the reminder lease) keeps the reminders due in the
+next REMINDER_WINDOW_MINUTES in a heap ordered by send time. The window is
+reloaded from the medications every REMINDER_REFRESH_SECONDS, so schedule
+edits are picked up on the next refresh. In between, the scheduler sleeps
+until the earliest reminder is due.
+
+Each medication records when its next reminder is due (next_reminder_at,
+in UTC), so a refresh only reads the medications with a reminder in the
+window, and only the fields needed to expand their schedule. Medication
+updates and push token registrations clear it to have it recomputed.
+
+Due reminders are grouped into batches of at most 100 messages and put on
+a bounded queue drained by a few sender tasks. When the gateway is slow
+the queue fills up and the scheduler waits for room rather than piling up
+requests. Batches the gateway refuses are retried with exponential
+backoff. Reminders that fall more than REMINDER_MAX_DELAY_SECONDS behind
+are dropped, because a late "take your pill soon" is worse than none.
+
+Schedules are expanded in each user's wall-clock time, using the timezone
+their device registered with its push token, and send times converted back
+to UTC.
+"""
+import asyncio
+import heapq
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+from pymongo import UpdateOne
+
+from dates import from_local, load_timezone, to_local
+from leases import Lease
+from models import DoseStatus, MedicationSchedule
+from push_gateway import MAX_MESSAGES_PER_REQUEST, PushGatewayError
+from scheduling import CompiledSchedule, virtual_dose_id
+
+logger = logging.getLogger(__name__)
+
+REMINDERS_ENABLED = os.getenv("REMINDERS_ENABLED", "true").lower() == "true"
+REMINDER_WINDOW_MINUTES = float(os.getenv("REMINDER_WINDOW_MINUTES", "15"))
+REMINDER_REFRESH_SECONDS = float(os.getenv("REMINDER_REFRESH_SECONDS", "300"))
+REMINDER_MAX_DELAY_SECONDS = float(os.getenv("REMINDER_MAX_DELAY_SECONDS", "600"))
+REMINDER_SEND_CONCURRENCY = int(os.getenv("REMINDER_SEND_CONCURRENCY", "4"))
+# Batches waiting for a sender before the scheduler has to wait
+REMINDER_QUEUE_BATCHES = int(os.getenv("REMINDER_QUEUE_BATCHES", "100"))
+REMINDER_MAX_ATTEMPTS = int(os.getenv("REMINDER_MAX_ATTEMPTS", "4"))
+REMINDER_RETRY_BASE_SECONDS = 1.0
+# How far ahead the next reminder is looked for before checking again anyway
+NEXT_REMINDER_HORIZON = timedelta(days=7)
+REMINDER_PROJECTION = {
+    field: 1 for field in (
+        "user_id", "drug_id", "drug_name", "dosage", "dosage_form", "frequency", "custom_frequency",
+        "specific_times", "start_date", "end_date", "active", "reminder_minutes_before",
+        "schedule_changed_at", "schedule_history",
+    )
+}
+
+REMINDER_TITLE = "İlaç Hatırlatıcısı"
+
+
+def reminder_message(token: str, dose_id: str, medication: MedicationSchedule, scheduled_time: datetime) -> dict:
+    """Push message for one dose, worded like the app's local reminders"""
+    return {
+        "to": token,
+        "title": REMINDER_TITLE,
+        "body": f"{medication.drug_name} ({medication.dosage}) alma zamanı yaklaşıyor",
+        "data": {
+            "medicationId": medication.id,
+            "doseId": dose_id,
+            "scheduledTime": scheduled_time.isoformat(),
+        },
+        "sound": "default",
+        "priority": "high",
+    }
+
+
+class ReminderScheduler:
+    """Loads upcoming reminders into a heap and sends them through the push gateway when due"""
+
+    def __init__(self, db, senders: int = REMINDER_SEND_CONCURRENCY):
+        self.db = db
+        self.gateway = None
+        self.senders = senders
+        self.window = timedelta(minutes=REMINDER_WINDOW_MINUTES)
+        self.lease = Lease(db.leases, "reminder_scheduler", duration=2 * REMINDER_REFRESH_SECONDS)
+        self._heap: List[Tuple[datetime, str]] = []
+        self._pending: Dict[str, dict] = {}
+        # Doses already reminded of, by send time, so a refresh does not queue them again
+        self._sent: Dict[str, datetime] = {}
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=REMINDER_QUEUE_BATCHES)
+        self._tasks: List[asyncio.Task] = []
+        self.leader = False
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.retries = 0
+
+    def start(self, gateway):
+        if not REMINDERS_ENABLED or self._tasks:
+            return
+        self.gateway = gateway
+        self._tasks = [asyncio.create_task(self._run())]
+        self._tasks += [asyncio.create_task(self._sender()) for _ in range(self.senders)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self.leader:
+            try:
+                await self.lease.release()
+            except Exception as e:
+                logger.error(f"Error releasing reminder scheduler lease: {e}")
+        if self.gateway is not None:
+            await self.gateway.close()
+
+    async def _run(self):
+        next_refresh = datetime.utcnow()
+        while True:
+            now = datetime.utcnow()
+            try:
+                if now >= next_refresh:
+                    next_refresh = now + timedelta(seconds=REMINDER_REFRESH_SECONDS)
+                    self.leader = await self.lease.acquire()
+                    if self.leader:
+                        await self.refresh(now)
+                    else:
+                        self._heap, self._pending = [], {}
+                if self.leader:
+                    await self.dispatch_due(datetime.utcnow())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error scheduling reminders: {e}")
+
+            wake = min(next_refresh, self._heap[0][0]) if self._heap else next_refresh
+            await asyncio.sleep(max((wake - datetime.utcnow()).total_seconds(), 0.05))
+
+    async def refresh(self, now: datetime) -> int:
+        """Reload the reminders due in [now, now + window]; returns how many are pending"""
+        window_end = now + self.window
+        medications = await self.db.medications.find({
+            "active": True,
+            "reminder_enabled": True,
+            "$or": [{"next_reminder_at": None}, {"next_reminder_at": {"$lte": window_end}}]
+        }, REMINDER_PROJECTION).to_list(None)
+        user_ids = list({med["user_id"] for med in medications})
+        users = {
+            user["_id"]: user
+            for user in await self.db.users.find(
+                {"_id": {"$in": user_ids}, "push_token": {"$ne": None}}, {"push_token": 1, "timezone": 1}
+            ).to_list(None)
+        }
+
+        due: Dict[str, Tuple[datetime, dict]] = {}
+        next_reminders = []
+        for med in medications:
+            user = users.get(med["user_id"])
+            if not user or not user["push_token"]:
+                # Registering a push token clears next_reminder_at again
+                next_reminders.append(UpdateOne({"_id": med["_id"]}, {"$set": {"next_reminder_at": now + NEXT_REMINDER_HORIZON}}))
+                continue
+            # Dose times are the user's wall clock
+            zone = load_timezone(user.get("timezone"))
+            schedule = CompiledSchedule(MedicationSchedule(**med))
+            lead = timedelta(minutes=schedule.medication.reminder_minutes_before)
+            local_now, local_end = to_local(now, zone), to_local(window_end, zone)
+            for scheduled_time in schedule.occurrences(local_now + lead, local_end + lead):
+                dose_id = virtual_dose_id(schedule.medication.id, scheduled_time)
+                if dose_id not in self._sent:
+                    message = reminder_message(user["push_token"], dose_id, schedule.medication, scheduled_time)
+                    due[dose_id] = (from_local(scheduled_time - lead, zone), message)
+
+            # The first reminder from now on, so the medication is read again while it is pending
+            upcoming = next(schedule.occurrences(local_now + lead, local_now + lead + NEXT_REMINDER_HORIZON), None)
+            next_reminder_at = from_local(upcoming - lead, zone) if upcoming else now + NEXT_REMINDER_HORIZON
+            next_reminders.append(UpdateOne({"_id": med["_id"]}, {"$set": {"next_reminder_at": next_reminder_at}}))
+        if next_reminders:
+            await self.db.medications.bulk_write(next_reminders, ordered=False)
+
+        # Doses already taken or skipped need no reminder
+        for dose in await self.db.dose_logs.find(
+            {"_id": {"$in": list(due)}, "status": {"$ne": DoseStatus.SCHEDULED}}, {"_id": 1}
+        ).to_list(None):
+            due.pop(dose["_id"], None)
+
+        self._heap = [(send_at, dose_id) for dose_id, (send_at, _) in due.items()]
+        heapq.heapify(self._heap)
+        self._pending = {dose_id: message for dose_id, (_, message) in due.items()}
+        self._sent = {dose_id: sent_at for dose_id, sent_at in self._sent.items() if sent_at >= now - self.window}
+        logger.info(f"Reminder window loaded with {len(self._pending)} reminders")
+        return len(self._pending)
+
+    async def dispatch_due(self, now: datetime) -> int:
+        """Queue every reminder due at `now` in gateway-sized batches; returns how many"""
+        messages = []
+        while self._heap and self._heap[0][0] <= now:
+            send_at, dose_id = heapq.heappop(self._heap)
+            message = self._pending.pop(dose_id, None)
+            if message is None:
+                continue
+            if (now - send_at).total_seconds() > REMINDER_MAX_DELAY_SECONDS:
+                self.dropped += 1
+                continue
+            self._sent[dose_id] = send_at
+            messages.append(message)
+
+        for start in range(0, len(messages), MAX_MESSAGES_PER_REQUEST):
+            # Waits here while the senders are behind
+            await self._queue.put(messages[start:start + MAX_MESSAGES_PER_REQUEST])
+        return len(messages)
+
+    async def _sender(self):
+        while True:
+            batch = await self._queue.get()
+            try:
+                await self.send_batch(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                logger.error(f"Error sending reminder batch: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def send_batch(self, messages: List[dict]):
+        """Send one batch, retrying with backoff while the gateway refuses it"""
+        for attempt in range(1, REMINDER_MAX_ATTEMPTS + 1):
+            try:
+                unregistered = await self.gateway.send(messages)
+            except PushGatewayError as e:
+                if not e.retryable or attempt == REMINDER_MAX_ATTEMPTS:
+                    self.failed += len(messages)
+                    logger.error(f"Reminder batch of {len(messages)} failed after {attempt} attempts: {e}")
+                    return
+                self.retries += 1
+                await asyncio.sleep(e.retry_after or REMINDER_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+                continue
+
+            self.sent += len(messages)
+            if unregistered:
+                await self.db.users.update_many(
+                    {"push_token": {"$in": unregistered}},
+                    {"$unset": {"push_token": "", "device_type": ""}}
+                )
+            return
+
+    async def drain(self):
+        """Wait until every queued batch has been handled"""
+        await self._queue.join()
+
+    def stats(self) -> dict:
+        return {
+            "leader": self.leader,
+            "pending": len(self._pending),
+            "queued_batches": self._queue.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "retries": self.retries,
+        }
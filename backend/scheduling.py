@@ -0,0 +1,326 @@
+"""
+Dose schedule expansion and dose-log re-materialization planning
+
+Upcoming doses are not stored: they are expanded on demand from a
+CompiledSchedule and only written to dose_logs once their state changes.
+Such documents carry a virtual dose id ("<medication_id>@<YYYYMMDDTHHMM>"),
+so the same dose has the same id before and after it is materialized.
+"""
+import re
+from datetime import datetime, timedelta
+from itertools import groupby
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from pymongo import DeleteOne, UpdateMany
+
+from dates import parse_datetime
+from documents import to_document
+from models import DoseLog, DoseStatus, FrequencyType, MedicationSchedule, ScheduleRevision
+
+# Window expanded by GET /api/doses when the client gives no dates
+DEFAULT_PAST_DAYS = 7
+DEFAULT_FUTURE_DAYS = 7
+# Widest window a single request may expand
+MAX_EXPANSION_DAYS = 92
+
+DEFAULT_DOSE_TIMES = {
+    FrequencyType.DAILY: ["08:00"],
+    FrequencyType.TWICE_DAILY: ["08:00", "20:00"],
+    FrequencyType.THREE_TIMES_DAILY: ["08:00", "14:00", "20:00"],
+    FrequencyType.FOUR_TIMES_DAILY: ["08:00", "12:00", "16:00", "20:00"],
+    FrequencyType.WEEKLY: ["08:00"],
+    FrequencyType.CUSTOM: ["08:00"],
+}
+
+# English and Turkish weekday abbreviations for custom frequencies
+WEEKDAYS = {
+    "mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6,
+    "pzt": 0, "sal": 1, "çar": 2, "car": 2, "per": 3, "cum": 4, "cmt": 5, "paz": 6,
+}
+
+_EVERY_RE = re.compile(r"(?:every|her)\s+(\d+)\s*(days?|gün|gun|hours?|saat|h|d)", re.IGNORECASE)
+_VIRTUAL_ID_FORMAT = "%Y%m%dT%H%M"
+
+
+def _naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is not None:
+        value = (value - value.utcoffset()).replace(tzinfo=None)
+    return value
+
+
+def parse_time_of_day(time_str: str) -> timedelta:
+    """Convert "HH:MM" into an offset from midnight"""
+    hour, minute = map(int, time_str.split(":"))
+    return timedelta(hours=hour, minutes=minute)
+
+
+def virtual_dose_id(medication_id: str, scheduled_time: datetime) -> str:
+    """Stable id of a schedule occurrence"""
+    return f"{medication_id}@{scheduled_time.strftime(_VIRTUAL_ID_FORMAT)}"
+
+
+def parse_virtual_dose_id(dose_id: str) -> Optional[Tuple[str, datetime]]:
+    """Split a virtual dose id into (medication_id, scheduled_time)"""
+    medication_id, sep, stamp = dose_id.rpartition("@")
+    if not sep or not medication_id:
+        return None
+    try:
+        return medication_id, datetime.strptime(stamp, _VIRTUAL_ID_FORMAT)
+    except ValueError:
+        return None
+
+
+def dose_key(medication_id: str, scheduled_time: datetime) -> Tuple[str, str]:
+    """Key used to match stored dose logs with schedule occurrences"""
+    return medication_id, scheduled_time.strftime(_VIRTUAL_ID_FORMAT)
+
+
+class Recurrence:
+    """One version of a schedule's recurrence rule, in effect over [effective_from, effective_until).
+
+    Doses fall on `offsets` (time of day) every `period_days` days counted
+    from the start date, optionally restricted to `weekdays`; "every N hours"
+    custom schedules use a fixed `interval` instead. `rule` is the
+    medication or one of its ScheduleRevisions.
+    """
+
+    def __init__(
+        self,
+        rule,
+        first_day: datetime,
+        end: Optional[datetime],
+        effective_from: datetime,
+        effective_until: Optional[datetime] = None
+    ):
+        self.dosage = rule.dosage
+        self.first_day = first_day
+        self.effective_from = effective_from
+        self.effective_until = effective_until
+
+        self.end = end
+        if rule.end_date:
+            rule_end = _naive_utc(rule.end_date)
+            self.end = min(self.end, rule_end) if self.end else rule_end
+        if effective_until:
+            until_end = effective_until - timedelta(microseconds=1)
+            self.end = min(self.end, until_end) if self.end else until_end
+
+        times = rule.specific_times or DEFAULT_DOSE_TIMES.get(rule.frequency, [])
+        self.offsets = sorted({parse_time_of_day(t) for t in times})
+        self.period_days = 1
+        self.weekdays: Optional[set] = None
+        self.interval: Optional[timedelta] = None
+
+        if not rule.active or rule.frequency == FrequencyType.AS_NEEDED:
+            self.offsets = []
+        elif rule.frequency == FrequencyType.WEEKLY:
+            self.period_days = 7
+        elif rule.frequency == FrequencyType.CUSTOM and rule.custom_frequency:
+            self._compile_custom(rule.custom_frequency)
+
+    def _compile_custom(self, rule: str):
+        match = _EVERY_RE.search(rule)
+        if match:
+            count = max(int(match.group(1)), 1)
+            if match.group(2).lower()[0] in ("h", "s"):
+                self.interval = timedelta(hours=count)
+            else:
+                self.period_days = count
+            return
+        tokens = re.split(r"[\s,;/]+", rule.lower())
+        weekdays = {WEEKDAYS[token[:3]] for token in tokens if token[:3] in WEEKDAYS}
+        if weekdays:
+            self.weekdays = weekdays
+
+    def occurrences(self, window_start: datetime, window_end: datetime) -> Iterator[datetime]:
+        """Yield dose times within [window_start, window_end] in ascending order"""
+        if not self.offsets:
+            return
+        window_end = min(window_end, self.end) if self.end else window_end
+        window_start = max(window_start, self.effective_from)
+        if window_start > window_end:
+            return
+
+        if self.interval:
+            anchor = self.first_day + self.offsets[0]
+            steps = max(0, -(-(window_start - anchor) // self.interval))
+            current = anchor + steps * self.interval
+            while current <= window_end:
+                yield current
+                current += self.interval
+            return
+
+        day_index = (window_start - self.first_day).days
+        day = self.first_day + timedelta(days=day_index)
+        while day <= window_end:
+            if day_index % self.period_days == 0 and (self.weekdays is None or day.weekday() in self.weekdays):
+                for offset in self.offsets:
+                    scheduled_time = day + offset
+                    if window_start <= scheduled_time <= window_end:
+                        yield scheduled_time
+            day_index += 1
+            day += timedelta(days=1)
+
+
+class CompiledSchedule:
+    """A MedicationSchedule's recurrence compiled once, with its earlier versions.
+
+    The start date is taken as a calendar day and end_date / duration_days
+    bound the recurrence. Schedule edits keep the rule they replace in
+    schedule_history, so each dose time is expanded from the version that
+    was in effect at that time and editing a schedule never rewrites past
+    doses.
+    """
+
+    def __init__(self, medication: MedicationSchedule):
+        self.medication = medication
+        start = _naive_utc(medication.start_date)
+        self.first_day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        end: Optional[datetime] = None
+        if medication.duration_days:
+            end = self.first_day + timedelta(days=medication.duration_days) - timedelta(microseconds=1)
+
+        rules = [(revision.effective_from, revision) for revision in medication.schedule_history]
+        rules.append((medication.schedule_changed_at, medication))
+        rules.sort(key=lambda entry: _naive_utc(entry[0]) if entry[0] else self.first_day)
+        starts = [max(_naive_utc(since), self.first_day) if since else self.first_day for since, _ in rules]
+        self.versions = [
+            Recurrence(rule, self.first_day, end, starts[i], starts[i + 1] if i + 1 < len(rules) else None)
+            for i, (_, rule) in enumerate(rules)
+        ]
+
+    def occurrences(self, window_start: datetime, window_end: datetime) -> Iterator[datetime]:
+        """Yield dose times within [window_start, window_end] in ascending order"""
+        for version in self.versions:
+            yield from version.occurrences(window_start, window_end)
+
+    def is_occurrence(self, scheduled_time: datetime) -> bool:
+        return any(True for _ in self.occurrences(scheduled_time, scheduled_time))
+
+    def version_at(self, scheduled_time: datetime) -> Recurrence:
+        """The version of the schedule in effect at a dose time"""
+        current = self.versions[0]
+        for version in self.versions[1:]:
+            if version.effective_from > scheduled_time:
+                break
+            current = version
+        return current
+
+    def virtual_dose(self, scheduled_time: datetime) -> DoseLog:
+        """The not-yet-stored SCHEDULED dose log for an occurrence"""
+        medication = self.medication
+        return DoseLog(
+            id=virtual_dose_id(medication.id, scheduled_time),
+            user_id=medication.user_id,
+            medication_id=medication.id,
+            drug_name=medication.drug_name,
+            dosage=self.version_at(scheduled_time).dosage,
+            scheduled_time=scheduled_time,
+            status=DoseStatus.SCHEDULED,
+            created_at=medication.created_at,
+            updated_at=medication.updated_at
+        )
+
+
+def virtual_dose_document(compiled: CompiledSchedule, scheduled_time: datetime) -> dict:
+    """Build the stored form of an occurrence, ready to be materialized"""
+    dose_dict = to_document(compiled.virtual_dose(scheduled_time))
+    dose_dict["created_at"] = datetime.utcnow()
+    dose_dict["updated_at"] = dose_dict["created_at"]
+    return dose_dict
+
+
+def schedule_revision(medication: dict) -> dict:
+    """The current schedule of a stored medication, as the revision an edit adds to schedule_history"""
+    return to_document(ScheduleRevision(effective_from=medication.get("schedule_changed_at"), **{
+        field: medication[field] for field in ScheduleRevision.model_fields
+        if field != "effective_from" and field in medication
+    }))
+
+
+def schedules_in_effect(since: datetime) -> dict:
+    """Filter for medications that may have doses from `since` on: active
+    ones, and ones deactivated since then, for their time before that"""
+    return {"$or": [{"active": True}, {"active": False, "schedule_changed_at": {"$gt": since}}]}
+
+
+def moved_dose_document(log: dict, medication: MedicationSchedule, scheduled_time: datetime, now: datetime) -> dict:
+    """A stored log moved to another dose time, re-keyed under that time's virtual id"""
+    return {
+        **log,
+        "_id": virtual_dose_id(medication.id, scheduled_time),
+        "scheduled_time": scheduled_time,
+        "dosage": medication.dosage,
+        "updated_at": now,
+    }
+
+
+def plan_dose_log_changes(
+    medication: MedicationSchedule,
+    existing: List[dict],
+    desired: List[datetime],
+    now: Optional[datetime] = None,
+    occupied: Iterable[datetime] = (),
+) -> Tuple[List, List[Tuple[dict, datetime]], List[dict]]:
+    """Diff stored future SCHEDULED logs against the desired dose times.
+
+    `existing` holds the medication's future SCHEDULED logs, `occupied` the
+    times of its future logs in any other state. Logs whose time is still
+    wanted are kept, logs left over are moved to a free wanted time on the
+    same day, and the rest are deleted. Wanted times without a log need no
+    write, since they are expanded virtually. Every write is guarded on the
+    SCHEDULED status so a dose taken in the meantime is never touched.
+
+    A dose log's id is the virtual id of its time, so a move is not an
+    update: the caller deletes the log and stores moved_dose_document() in
+    its place.
+
+    Returns the write operations, the moves as (log, new time) and the logs
+    planned for deletion.
+    """
+    now = now or datetime.utcnow()
+
+    existing_by_time: Dict[datetime, List[dict]] = {}
+    for log in existing:
+        scheduled_time = parse_datetime(log["scheduled_time"])
+        existing_by_time.setdefault(scheduled_time, []).append(log)
+
+    wanted = sorted(set(desired))
+    stale = []
+    for scheduled_time, logs in existing_by_time.items():
+        # Keep one log per wanted time; duplicates are dropped
+        keep = 1 if scheduled_time in wanted else 0
+        stale.extend((scheduled_time, log) for log in logs[keep:])
+    taken = set(occupied)
+    missing = [t for t in wanted if t not in existing_by_time and t not in taken]
+
+    moves = []
+    stale.sort(key=lambda item: item[0])
+    stale_by_day = {
+        day: list(items) for day, items in groupby(stale, key=lambda item: item[0].date())
+    }
+    for day, times in groupby(missing, key=lambda t: t.date()):
+        movable = stale_by_day.pop(day, [])
+        times = list(times)
+        moves.extend((log, scheduled_time) for scheduled_time, (_, log) in zip(times, movable))
+        if len(movable) > len(times):
+            stale_by_day[day] = movable[len(times):]
+
+    operations = []
+    dropped = [log for items in stale_by_day.values() for _, log in items]
+    for log in dropped:
+        operations.append(DeleteOne({"_id": log["_id"], "status": DoseStatus.SCHEDULED}))
+
+    moved_ids = {log["_id"] for log, _ in moves}
+    if any(log.get("dosage") != medication.dosage for log in existing if log["_id"] not in moved_ids):
+        operations.append(UpdateMany(
+            {
+                "medication_id": medication.id,
+                "status": DoseStatus.SCHEDULED,
+                "scheduled_time": {"$gte": now}
+            },
+            {"$set": {"dosage": medication.dosage, "updated_at": now}}
+        ))
+
+    return operations, moves, dropped
@@ -0,0 +1,145 @@
+"""
+In-memory drug search index for Medilog
+
+The drug catalog is small and rarely changes, so it is kept in process and
+searched with a trigram / word-prefix index instead of an unanchored $regex
+per keystroke. Text is folded Turkish-aware before indexing, so "İ", "I",
+"ı" and "i" all match each other and "ş", "ğ", "ç", "ö", "ü" match their
+plain Latin letters.
+"""
+import time
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+TURKISH_FOLD = str.maketrans({
+    "İ": "i", "I": "i", "ı": "i",
+    "Ş": "s", "ş": "s",
+    "Ğ": "g", "ğ": "g",
+    "Ç": "c", "ç": "c",
+    "Ö": "o", "ö": "o",
+    "Ü": "u", "ü": "u",
+})
+
+# Rank of a match; higher is better
+EXACT_NAME = 100
+NAME_PREFIX = 80
+NAME_WORD_PREFIX = 60
+INGREDIENT_PREFIX = 50
+NAME_SUBSTRING = 40
+INGREDIENT_WORD_PREFIX = 30
+INGREDIENT_SUBSTRING = 20
+
+
+def fold(text: Optional[str]) -> str:
+    """Case- and accent-insensitive form of a string, with Turkish dotted/dotless i"""
+    if not text:
+        return ""
+    text = text.translate(TURKISH_FOLD).lower()
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def _grams(text: str) -> Set[str]:
+    """Trigrams of the text plus 1-2 character word prefixes (marked with ^)"""
+    grams = {text[i:i + 3] for i in range(len(text) - 2)}
+    for word in text.split():
+        grams.add("^" + word[:1])
+        grams.add("^" + word[:2])
+    return grams
+
+
+def _query_grams(query: str) -> Set[str]:
+    if len(query) < 3:
+        return {"^" + query}
+    return {query[i:i + 3] for i in range(len(query) - 2)}
+
+
+def _score(query: str, name: str, ingredient: str) -> int:
+    if name == query:
+        return EXACT_NAME
+    if name.startswith(query):
+        return NAME_PREFIX
+    if any(word.startswith(query) for word in name.split()):
+        return NAME_WORD_PREFIX
+    if ingredient.startswith(query):
+        return INGREDIENT_PREFIX
+    if query in name:
+        return NAME_SUBSTRING
+    if any(word.startswith(query) for word in ingredient.split()):
+        return INGREDIENT_WORD_PREFIX
+    if query in ingredient:
+        return INGREDIENT_SUBSTRING
+    return 0
+
+
+class DrugSearchIndex:
+    """Ranked search over drug name and active ingredient"""
+
+    def __init__(self, max_age_seconds: float = 300):
+        self.max_age_seconds = max_age_seconds
+        self.built_at: Optional[float] = None
+        self._docs: Dict[str, dict] = {}
+        self._folded: Dict[str, Tuple[str, str]] = {}
+        self._postings: Dict[str, Set[str]] = {}
+
+    @property
+    def is_stale(self) -> bool:
+        """True until built, and again once older than max_age_seconds.
+
+        Writes on other workers are only seen after a rebuild, so the index
+        is refreshed from the database periodically.
+        """
+        return self.built_at is None or time.monotonic() - self.built_at > self.max_age_seconds
+
+    def build(self, docs: Iterable[dict]):
+        """Replace the whole index with the given drug documents"""
+        self._docs, self._folded, self._postings = {}, {}, {}
+        for doc in docs:
+            self.upsert(doc)
+        self.built_at = time.monotonic()
+
+    def upsert(self, doc: dict):
+        """Add a drug, or re-index it after an update"""
+        drug_id = doc["_id"]
+        self.remove(drug_id)
+        name, ingredient = fold(doc.get("name")), fold(doc.get("active_ingredient"))
+        self._docs[drug_id] = doc
+        self._folded[drug_id] = (name, ingredient)
+        for gram in _grams(name) | _grams(ingredient):
+            self._postings.setdefault(gram, set()).add(drug_id)
+
+    def remove(self, drug_id: str):
+        folded = self._folded.pop(drug_id, None)
+        self._docs.pop(drug_id, None)
+        if folded is None:
+            return
+        for gram in _grams(folded[0]) | _grams(folded[1]):
+            postings = self._postings.get(gram)
+            if postings is not None:
+                postings.discard(drug_id)
+                if not postings:
+                    del self._postings[gram]
+
+    def search(self, query: str, category: Optional[str] = None, limit: Optional[int] = None) -> List[dict]:
+        """Drug documents matching the query, best match first"""
+        query = " ".join(fold(query).split())
+        if not query:
+            return []
+
+        candidates: Optional[Set[str]] = None
+        for gram in _query_grams(query):
+            postings = self._postings.get(gram, set())
+            candidates = postings.copy() if candidates is None else candidates & postings
+            if not candidates:
+                return []
+
+        ranked = []
+        for drug_id in candidates:
+            doc = self._docs[drug_id]
+            if category and doc.get("category") != category:
+                continue
+            score = _score(query, *self._folded[drug_id])
+            if score:
+                ranked.append((-score, self._folded[drug_id][0], drug_id))
+        ranked.sort()
+        return [self._docs[drug_id] for _, _, drug_id in ranked[:limit]]
@@ -12,6 +12,7 @@ sys.path.append(str(Path(__file__).parent))
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 from dotenv import load_dotenv
+from documents import to_document
 from models import Drug, Pharmacokinetics, DosageForm
 
 load_dotenv()
@@ -193,9 +194,7 @@ async def seed_drugs():
     
     for drug_data in turkish_cardio_drugs:
         drug = Drug(**drug_data)
-        drug_dict = drug.dict()
-        drug_dict["created_at"] = drug.created_at.isoformat()
-        drug_dict["updated_at"] = drug.updated_at.isoformat()
+        drug_dict = to_document(drug)
         
         result = await db.drugs.insert_one(drug_dict)
         print(f"✓ Eklendi: {drug.name} (ID: {drug.id})")
@@ -1,25 +1,66 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, UploadFile
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, File, UploadFile, Query, Request, Response
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+from starlette.responses import StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
-from typing import List, Optional
-from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 import base64
-import anthropic
+import hashlib
+import numpy as np
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 from models import (
-    Drug, DrugCreate,
+    Drug, DrugCreate, ConcentrationProfile, ConcentrationCurve,
     MedicationSchedule, MedicationScheduleCreate, MedicationScheduleUpdate,
     DoseLog, DoseLogCreate, DoseLogUpdate,
+    DoseBulkUpdate, DoseBulkResult, DoseBulkResponse,
+    Pharmacokinetics, PlasmaLevelTimeline, PlasmaLevelSeries,
     ProgressTracking, ProgressStats, DailyAdherence,
-    SuccessResponse, DoseStatus,
+    SuccessResponse, DoseStatus, AnalysisJob,
     User, UserCreate, UserLogin, Token, PushTokenCreate
 )
 from auth import (
-    get_password_hash, verify_password, create_access_token,
-    get_current_user, get_current_active_user, security
+    create_access_token,
+    get_current_user, get_current_active_user, security,
+    invalidate_user, user_cache, password_hasher
+)
+from pharmacokinetics import (
+    pk_parameters, concentration_curves, superpose_doses, washout_hours,
+    parse_dose_amount, sample_times, DEFAULT_DOSE_AMOUNT
+)
+from adherence import (
+    record_dose_change, rollup_update, rollup_date, status_increments, expected_counts,
+    progress_pipeline, backfill_pipeline, COUNTERS as ROLLUP_COUNTERS
+)
+from ai_client import create_analyzer
+from analysis_jobs import AnalysisJobRunner, MAX_BATCH_IMAGES
+from cache import TTLCache
+from dates import is_timezone, mongo_precision, parse_datetime
+from documents import from_document, to_document
+from dose_sweeper import MissedDoseSweeper
+from image_cache import ImageAnalysisCache
+from image_processing import image_processor, read_upload
+from fieldsets import parse_fields, projection
+from indexes import ensure_indexes
+from responses import json_response
+from push_gateway import create_push_gateway
+from reminders import ReminderScheduler
+from pagination import (
+    MAX_PAGE_SIZE, NEXT_CURSOR_HEADER,
+    decode_cursor, encode_cursor, fetch_page, find_all, ndjson_lines, page_size
+)
+from search_index import DrugSearchIndex
+from streaks import get_streak, invalidate_streak
+from scheduling import (
+    CompiledSchedule, moved_dose_document, plan_dose_log_changes, schedule_revision, schedules_in_effect, virtual_dose_document,
+    parse_virtual_dose_id, dose_key,
+    DEFAULT_PAST_DAYS, DEFAULT_FUTURE_DAYS, MAX_EXPANSION_DAYS
 )
 
 
@@ -32,11 +73,36 @@ client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
 # Create the main app without a prefix
-app = FastAPI(title="PharmacoKinetic API", version="1.0.0")
+app = FastAPI(title="PharmacoKinetic API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
+# In-process search index and read-through cache over the drug catalog
+drug_search_index = DrugSearchIndex()
+drug_cache = TTLCache(maxsize=256, ttl=60)
+
+# Shared AI client, created at startup
+drug_image_analyzer = None
+# Persistent cache of image analysis results
+image_analysis_cache = ImageAnalysisCache(db.image_analysis_cache)
+# Background batch image analysis; its images queue for the image pool instead of being refused when busy
+analysis_jobs = AnalysisJobRunner(db.analysis_jobs, lambda contents: analyze_image_contents(contents, wait=True))
+# Periodic sweep of overdue doses to MISSED
+missed_dose_sweeper = MissedDoseSweeper(db)
+# Push reminders for upcoming doses, gateway created at startup
+reminder_scheduler = ReminderScheduler(db)
+
+# Upper bound on samples per concentration curve
+MAX_CONCENTRATION_POINTS = 5000
+# Widest window served by the plasma level timeline
+MAX_PLASMA_WINDOW_HOURS = 24 * 14
+# Most doses accepted by one bulk status update
+MAX_BULK_DOSES = 200
+DUPLICATE_KEY = 11000
+# Medication fields whose changes require re-materializing dose logs
+SCHEDULE_FIELDS = {"dosage", "frequency", "specific_times", "end_date", "active"}
+
 
 # ============ DEPENDENCY FUNCTIONS ============
 
@@ -52,6 +118,21 @@ async def root():
     return {"message": "PharmacoKinetic API v1.0", "status": "active"}
 
 
+@api_router.get("/metrics")
+async def get_metrics():
+    """In-process cache and worker statistics"""
+    return {
+        "user_cache": user_cache.stats(),
+        "drug_cache": drug_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "drug_image_analyzer": drug_image_analyzer.stats() if drug_image_analyzer else None,
+        "image_analysis_cache": image_analysis_cache.stats(),
+        "image_processor": image_processor.stats(),
+        "missed_dose_sweeper": missed_dose_sweeper.stats(),
+        "reminder_scheduler": reminder_scheduler.stats(),
+    }
+
+
 # ============ AUTH ROUTES ============
 
 @api_router.post("/auth/register", response_model=Token)
@@ -66,12 +147,10 @@ async def register(user_data: UserCreate):
     user = User(
         email=user_data.email,
         full_name=user_data.full_name,
-        hashed_password=get_password_hash(user_data.password)
+        hashed_password=await password_hasher.hash(user_data.password)
     )
 
-    user_dict = user.dict()
-    user_dict["created_at"] = user.created_at.isoformat()
-    user_dict["updated_at"] = user.updated_at.isoformat()
+    user_dict = to_document(user)
 
     result = await db.users.insert_one(user_dict)
     if not result.inserted_id:
@@ -94,12 +173,20 @@ async def register(user_data: UserCreate):
 async def login(credentials: UserLogin):
     """Login with email and password"""
     user = await db.users.find_one({"email": credentials.email})
-    if not user or not verify_password(credentials.password, user["hashed_password"]):
+    if not user:
+        raise HTTPException(status_code=401, detail="Incorrect email or password")
+
+    verified, new_hash = await password_hasher.verify_and_update(credentials.password, user["hashed_password"])
+    if not verified:
         raise HTTPException(
             status_code=401,
             detail="Incorrect email or password"
         )
 
+    # Rehash transparently when the configured bcrypt cost has changed
+    if new_hash:
+        await db.users.update_one({"_id": user["_id"]}, {"$set": {"hashed_password": new_hash}})
+
     if not user.get("is_active", True):
         raise HTTPException(status_code=400, detail="Inactive user")
 
@@ -109,7 +196,7 @@ async def login(credentials: UserLogin):
     return Token(
         access_token=access_token,
         user={
-            "id": user["id"],
+            "id": from_document(user)["id"],
             "email": user["email"],
             "full_name": user["full_name"]
         }
@@ -132,17 +219,29 @@ async def register_push_token(
     token_data: PushTokenCreate,
     current_user: dict = Depends(get_current_user_dep)
 ):
-    """Register push notification token for the current user"""
+    """Register push notification token for the current user.
+
+    The device's timezone is stored with it, since reminders are sent at
+    the dose times of the user's wall clock.
+    """
+    if token_data.timezone and not is_timezone(token_data.timezone):
+        raise HTTPException(status_code=400, detail="Unknown timezone")
+    update = {
+        "push_token": token_data.token,
+        "device_type": token_data.device_type,
+        "updated_at": datetime.utcnow()
+    }
+    if token_data.timezone:
+        update["timezone"] = token_data.timezone
     try:
         # Update user's push token
-        await db.users.update_one(
-            {"id": current_user["id"]},
-            {"$set": {
-                "push_token": token_data.token,
-                "device_type": token_data.device_type,
-                "updated_at": datetime.utcnow().isoformat()
-            }}
-        )
+        await db.users.update_one({"_id": current_user["id"]}, {"$set": update})
+        # Next due times are kept in UTC; have reminders for the new token recomputed
+        resets = {"next_reminder_at": None}
+        if token_data.timezone and token_data.timezone != current_user.get("timezone"):
+            resets["missed_check_at"] = None
+        await db.medications.update_many({"user_id": current_user["id"]}, {"$set": resets})
+        invalidate_user(current_user["email"])
         return SuccessResponse(message="Push token registered successfully")
     except Exception as e:
         logger.error(f"Error registering push token: {e}")
@@ -154,9 +253,10 @@ async def unregister_push_token(current_user: dict = Depends(get_current_user_de
     """Unregister push notification token for the current user"""
     try:
         await db.users.update_one(
-            {"id": current_user["id"]},
+            {"_id": current_user["id"]},
             {"$unset": {"push_token": "", "device_type": ""}}
         )
+        invalidate_user(current_user["email"])
         return SuccessResponse(message="Push token unregistered successfully")
     except Exception as e:
         logger.error(f"Error unregistering push token: {e}")
@@ -172,151 +272,215 @@ async def analyze_drug_image(
 ):
     """Analyze drug box image using AI to extract drug information"""
     try:
-        # Read image file
-        contents = await file.read()
-        base64_image = base64.b64encode(contents).decode('utf-8')
-
-        # Determine media type
-        media_type = file.content_type or "image/jpeg"
-
-        # Initialize Anthropic client
-        api_key = os.getenv("ANTHROPIC_API_KEY")
-        if not api_key:
-            raise HTTPException(status_code=500, detail="AI API key not configured")
-
-        client = anthropic.Anthropic(api_key=api_key)
-
-        # Analyze image with Claude
-        message = client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=1024,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": media_type,
-                                "data": base64_image,
-                            },
-                        },
-                        {
-                            "type": "text",
-                            "text": """Analyze this drug/medication box image and extract the following information in JSON format:
-{
-  "name": "Commercial drug name",
-  "active_ingredient": "Active ingredient name",
-  "description": "Brief description",
-  "dosage_forms": ["tablet", "capsule", etc],
-  "standard_dosages": ["10mg", "20mg", etc],
-  "category": "Drug category"
-}
-
-If this is not a medication box or you cannot extract the information, return:
-{
-  "error": "Unable to extract drug information from image"
-}
-
-IMPORTANT: Return ONLY valid JSON, no additional text."""
-                        }
-                    ],
-                }
-            ],
-        )
-
-        # Parse response
-        response_text = message.content[0].text
-
-        # Try to parse JSON from response
-        import json
-        try:
-            drug_info = json.loads(response_text)
-            if "error" in drug_info:
-                return {"success": False, "message": drug_info["error"]}
-            return {"success": True, "data": drug_info}
-        except json.JSONDecodeError:
-            # Try to extract JSON from text if Claude added extra text
-            import re
-            json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-            if json_match:
-                drug_info = json.loads(json_match.group())
-                if "error" in drug_info:
-                    return {"success": False, "message": drug_info["error"]}
-                return {"success": True, "data": drug_info}
-            else:
-                return {"success": False, "message": "Could not parse AI response"}
+        contents = await read_upload(file)
+        return await analyze_image_contents(contents)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error analyzing image: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@api_router.post("/analyze-drug-images", response_model=AnalysisJob, status_code=202)
+async def submit_drug_image_batch(
+    files: List[UploadFile] = File(...),
+    current_user: dict = Depends(get_current_user_dep)
+):
+    """Start analyzing several drug box images; poll or stream the returned job for results"""
+    if len(files) > MAX_BATCH_IMAGES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IMAGES} images per batch")
+
+    uploads = [(file.filename, await read_upload(file)) for file in files]
+    return await analysis_jobs.submit(current_user["id"], uploads)
+
+
+@api_router.get("/analysis-jobs/{job_id}", response_model=AnalysisJob)
+async def get_analysis_job(job_id: str, current_user: dict = Depends(get_current_user_dep)):
+    """Get a batch analysis job with the results finished so far"""
+    return await analysis_jobs.get(job_id, current_user["id"])
+
+
+@api_router.get("/analysis-jobs/{job_id}/stream")
+async def stream_analysis_job(job_id: str, current_user: dict = Depends(get_current_user_dep)):
+    """Stream a batch job's image results as NDJSON as they finish"""
+    await analysis_jobs.get(job_id, current_user["id"])
+    return StreamingResponse(
+        analysis_jobs.stream(job_id, current_user["id"]),
+        media_type="application/x-ndjson"
+    )
+
+
+async def analyze_image_contents(contents: bytes, wait: bool = False) -> dict:
+    """Preprocess an uploaded image and analyze it, answering repeat scans from the cache.
+
+    With wait=True the image waits for the image pool instead of failing with 503.
+    """
+    # Downsample and re-encode off the event loop
+    image = await image_processor.prepare(contents, wait=wait)
+
+    cached = await image_analysis_cache.lookup(image.digest, image.phash)
+    if cached is not None:
+        return {"success": True, "data": cached}
+
+    base64_image = base64.b64encode(image.data).decode('utf-8')
+    result = await drug_image_analyzer.analyze(base64_image, image.media_type)
+    if result["success"]:
+        await image_analysis_cache.store(image.digest, image.phash, result["data"])
+    return result
+
+
 # ============ DRUG ROUTES ============
 
 @api_router.post("/drugs", response_model=Drug)
 async def create_drug(drug: DrugCreate):
     """Create a new drug in the database"""
     drug_obj = Drug(**drug.dict())
-    drug_dict = drug_obj.dict()
-    
-    # Convert datetime objects to ISO format for MongoDB
-    drug_dict["created_at"] = drug_obj.created_at.isoformat()
-    drug_dict["updated_at"] = drug_obj.updated_at.isoformat()
-    
+    drug_dict = to_document(drug_obj)
+
     result = await db.drugs.insert_one(drug_dict)
     if result.inserted_id:
+        drug_search_index.upsert(drug_dict)
+        drug_cache.clear()
         return drug_obj
     raise HTTPException(status_code=500, detail="Failed to create drug")
 
 
 @api_router.get("/drugs", response_model=List[Drug])
-async def get_drugs(search: Optional[str] = None, category: Optional[str] = None):
-    """Get all drugs, optionally filtered by search term or category"""
-    query = {}
+async def get_drugs(
+    request: Request,
+    search: Optional[str] = None,
+    category: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    fields: Optional[str] = None
+):
+    """Get drugs, optionally filtered by search term or category.
+
+    Pages are ordered by creation; the next page's cursor is returned in the
+    X-Next-Cursor header. With stream=true all matching drugs are sent as NDJSON.
+    fields=name,category limits each drug to the listed fields.
+    """
+    selected = parse_fields(fields, Drug)
+    limit = page_size(limit, cursor)
     if search:
-        query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"active_ingredient": {"$regex": search, "$options": "i"}}
-        ]
+        # Searches are answered from the in-memory index, ranked by relevance
+        if drug_search_index.is_stale:
+            await refresh_drug_search_index()
+        return json_response(drug_search_index.search(search, category, limit), Drug, selected)
+
+    query = {}
     if category:
         query["category"] = category
-    
-    drugs = await db.drugs.find(query).to_list(1000)
-    return [Drug(**drug) for drug in drugs]
+    if stream:
+        return StreamingResponse(
+            ndjson_lines(find_all(db.drugs, query, "_id", ASCENDING, cursor, projection(selected)), Drug, selected),
+            media_type="application/x-ndjson"
+        )
+
+    async def load_drugs():
+        docs, next_cursor = await fetch_page(
+            db.drugs, query, "_id", ASCENDING, limit, cursor, projection(selected, "updated_at")
+        )
+        # Cache the encoded page so hits skip serialization entirely
+        return json_response(docs, Drug, selected).body, next_cursor, catalog_validators(docs)
+
+    body, next_cursor, validators = await drug_cache.get_or_load(
+        ("list", category, limit, cursor, selected), load_drugs
+    )
+    headers = validator_headers(*validators)
+    if next_cursor:
+        headers[NEXT_CURSOR_HEADER] = next_cursor
+    if not_modified(request, *validators):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @api_router.get("/drugs/{drug_id}", response_model=Drug)
-async def get_drug(drug_id: str):
+async def get_drug(drug_id: str, request: Request, response: Response):
     """Get a specific drug by ID"""
-    drug = await db.drugs.find_one({"id": drug_id})
+    async def load_drug():
+        drug = await db.drugs.find_one({"_id": drug_id})
+        if not drug:
+            raise HTTPException(status_code=404, detail="Drug not found")
+        return Drug(**drug), catalog_validators([drug])
+
+    drug, validators = await drug_cache.get_or_load(("drug", drug_id), load_drug)
+    if not_modified(request, *validators):
+        return Response(status_code=304, headers=validator_headers(*validators))
+    response.headers.update(validator_headers(*validators))
+    return drug
+
+
+@api_router.get("/drugs/{drug_id}/concentration", response_model=ConcentrationProfile)
+async def get_drug_concentration(
+    drug_id: str,
+    hours: float = Query(24.0, gt=0, le=24 * 14),
+    resolution: float = Query(0.5, gt=0, description="Hours between samples"),
+    doses: Optional[List[float]] = Query(None, description="Dose amounts, defaults to the standard dosages")
+):
+    """Get single-dose concentration-time curves for a drug"""
+    if hours / resolution > MAX_CONCENTRATION_POINTS:
+        raise HTTPException(status_code=400, detail="Resolution too fine for the requested time span")
+
+    drug = await db.drugs.find_one({"_id": drug_id})
     if not drug:
         raise HTTPException(status_code=404, detail="Drug not found")
-    return Drug(**drug)
+    drug_obj = Drug(**drug)
+
+    if not doses:
+        doses = [a for a in (parse_dose_amount(d) for d in drug_obj.standard_dosages) if a]
+    if not doses:
+        doses = [DEFAULT_DOSE_AMOUNT]
+
+    params = pk_parameters([drug_obj.pharmacokinetics])
+    times = sample_times(hours, resolution)
+    curves = concentration_curves(params, np.array([doses], dtype=float), times)[0]
+    peaks = np.array(doses, dtype=float) * params.fraction[0]
+
+    return ConcentrationProfile(
+        drug_id=drug_obj.id,
+        drug_name=drug_obj.name,
+        absorption_rate=round(float(params.ka[0]), 6),
+        elimination_rate=round(float(params.ke[0]), 6),
+        times=np.round(times, 4).tolist(),
+        curves=[
+            ConcentrationCurve(
+                dose=dose,
+                peak_concentration=round(float(peak), 4),
+                peak_time=float(params.tmax[0]),
+                concentrations=np.round(curve, 4).tolist()
+            )
+            for dose, peak, curve in zip(doses, peaks, curves)
+        ]
+    )
 
 
 @api_router.put("/drugs/{drug_id}", response_model=Drug)
 async def update_drug(drug_id: str, drug: DrugCreate):
     """Update an existing drug"""
-    existing = await db.drugs.find_one({"id": drug_id})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Drug not found")
-    
     update_data = drug.dict()
-    update_data["updated_at"] = datetime.utcnow().isoformat()
-    
-    await db.drugs.update_one({"id": drug_id}, {"$set": update_data})
-    updated_drug = await db.drugs.find_one({"id": drug_id})
+    update_data["updated_at"] = datetime.utcnow()
+
+    updated_drug = await db.drugs.find_one_and_update(
+        {"_id": drug_id}, {"$set": update_data}, return_document=ReturnDocument.AFTER
+    )
+    if not updated_drug:
+        raise HTTPException(status_code=404, detail="Drug not found")
+    drug_search_index.upsert(updated_drug)
+    drug_cache.clear()
     return Drug(**updated_drug)
 
 
 @api_router.delete("/drugs/{drug_id}", response_model=SuccessResponse)
 async def delete_drug(drug_id: str):
     """Delete a drug"""
-    result = await db.drugs.delete_one({"id": drug_id})
+    result = await db.drugs.delete_one({"_id": drug_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Drug not found")
+    drug_search_index.remove(drug_id)
+    drug_cache.clear()
     return SuccessResponse(message="Drug deleted successfully")
 
 
@@ -329,19 +493,11 @@ async def create_medication_schedule(
 ):
     """Create a new medication schedule"""
     med_obj = MedicationSchedule(**medication.dict(), user_id=current_user["id"])
-    med_dict = med_obj.dict()
-    
-    # Convert datetime objects to ISO format
-    med_dict["start_date"] = med_obj.start_date.isoformat()
-    if med_obj.end_date:
-        med_dict["end_date"] = med_obj.end_date.isoformat()
-    med_dict["created_at"] = med_obj.created_at.isoformat()
-    med_dict["updated_at"] = med_obj.updated_at.isoformat()
-    
+    med_dict = to_document(med_obj)
+
+    # Doses are expanded from the schedule on read, nothing else to store
     result = await db.medications.insert_one(med_dict)
     if result.inserted_id:
-        # Generate dose logs for this medication
-        await generate_dose_logs(med_obj)
         return med_obj
     raise HTTPException(status_code=500, detail="Failed to create medication schedule")
 
@@ -349,15 +505,33 @@ async def create_medication_schedule(
 @api_router.get("/medications", response_model=List[MedicationSchedule])
 async def get_medications(
     active_only: bool = True,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    fields: Optional[str] = None,
     current_user: dict = Depends(get_current_user_dep)
 ):
-    """Get all medication schedules"""
+    """Get medication schedules, newest first, a page at a time (or all as NDJSON with stream=true)"""
+    selected = parse_fields(fields, MedicationSchedule)
+    limit = page_size(limit, cursor)
     query = {"user_id": current_user["id"]}
     if active_only:
         query["active"] = True
 
-    medications = await db.medications.find(query).sort("created_at", -1).to_list(1000)
-    return [MedicationSchedule(**med) for med in medications]
+    if stream:
+        return StreamingResponse(
+            ndjson_lines(
+                find_all(db.medications, query, "_id", DESCENDING, cursor, projection(selected)),
+                MedicationSchedule, selected
+            ),
+            media_type="application/x-ndjson"
+        )
+
+    medications, next_cursor = await fetch_page(
+        db.medications, query, "_id", DESCENDING, limit, cursor, projection(selected)
+    )
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else {}
+    return json_response(medications, MedicationSchedule, selected, headers)
 
 
 @api_router.get("/medications/{medication_id}", response_model=MedicationSchedule)
@@ -366,7 +540,7 @@ async def get_medication(
     current_user: dict = Depends(get_current_user_dep)
 ):
     """Get a specific medication schedule"""
-    medication = await db.medications.find_one({"id": medication_id, "user_id": current_user["id"]})
+    medication = await db.medications.find_one({"_id": medication_id, "user_id": current_user["id"]})
     if not medication:
         raise HTTPException(status_code=404, detail="Medication not found")
     return MedicationSchedule(**medication)
@@ -379,16 +553,38 @@ async def update_medication(
     current_user: dict = Depends(get_current_user_dep)
 ):
     """Update a medication schedule"""
-    existing = await db.medications.find_one({"id": medication_id, "user_id": current_user["id"]})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Medication not found")
-
     update_data = {k: v for k, v in medication.dict().items() if v is not None}
-    update_data["updated_at"] = datetime.utcnow().isoformat()
+    update_data["updated_at"] = datetime.utcnow()
+    # Recomputed by the reminder scheduler on its next refresh
+    update_data["next_reminder_at"] = None
+    if medication.end_date:
+        update_data["end_date"] = parse_datetime(medication.end_date)
+
+    query = {"_id": medication_id, "user_id": current_user["id"]}
+    update = {"$set": update_data}
+    schedule_edited = bool(SCHEDULE_FIELDS.intersection(update_data))
+    if schedule_edited:
+        # Past doses keep the schedule they were due under: the replaced
+        # version goes to schedule_history, and the edit applies from now on
+        existing = await db.medications.find_one(query)
+        if not existing:
+            raise HTTPException(status_code=404, detail="Medication not found")
+        # Guarded on the version read, so a concurrent edit is not lost from the history
+        query["schedule_changed_at"] = existing.get("schedule_changed_at")
+        update_data["schedule_changed_at"] = update_data["updated_at"]
+        update["$push"] = {"schedule_history": schedule_revision(existing)}
+
+    updated_med = await db.medications.find_one_and_update(query, update, return_document=ReturnDocument.AFTER)
+    if not updated_med:
+        if schedule_edited:
+            raise HTTPException(status_code=409, detail="Medication changed concurrently, please retry")
+        raise HTTPException(status_code=404, detail="Medication not found")
+    updated_obj = MedicationSchedule(**updated_med)
 
-    await db.medications.update_one({"id": medication_id}, {"$set": update_data})
-    updated_med = await db.medications.find_one({"id": medication_id})
-    return MedicationSchedule(**updated_med)
+    # Schedule edits are reflected in the future dose logs
+    if schedule_edited:
+        await rematerialize_dose_logs(updated_obj)
+    return updated_obj
 
 
 @api_router.delete("/medications/{medication_id}", response_model=SuccessResponse)
@@ -397,12 +593,14 @@ async def delete_medication(
     current_user: dict = Depends(get_current_user_dep)
 ):
     """Delete a medication schedule"""
-    result = await db.medications.delete_one({"id": medication_id, "user_id": current_user["id"]})
+    result = await db.medications.delete_one({"_id": medication_id, "user_id": current_user["id"]})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Medication not found")
 
-    # Also delete associated dose logs
+    # Also delete associated dose logs and their rollups
     await db.dose_logs.delete_many({"medication_id": medication_id, "user_id": current_user["id"]})
+    await db.daily_adherence.delete_many({"medication_id": medication_id, "user_id": current_user["id"]})
+    await invalidate_streak(db, current_user["id"])
     return SuccessResponse(message="Medication deleted successfully")
 
 
@@ -415,16 +613,12 @@ async def create_dose_log(
 ):
     """Create a new dose log"""
     dose_obj = DoseLog(**dose.dict(), user_id=current_user["id"])
-    dose_dict = dose_obj.dict()
-    
-    dose_dict["scheduled_time"] = dose_obj.scheduled_time.isoformat()
-    if dose_obj.actual_time:
-        dose_dict["actual_time"] = dose_obj.actual_time.isoformat()
-    dose_dict["created_at"] = dose_obj.created_at.isoformat()
-    dose_dict["updated_at"] = dose_obj.updated_at.isoformat()
-    
+    dose_dict = to_document(dose_obj)
+
     result = await db.dose_logs.insert_one(dose_dict)
     if result.inserted_id:
+        await record_dose_change(db, dose_dict, None, dose_obj.status, stored=1)
+        await invalidate_streak(db, dose_obj.user_id, dose_obj.scheduled_time)
         return dose_obj
     raise HTTPException(status_code=500, detail="Failed to create dose log")
 
@@ -435,23 +629,75 @@ async def get_dose_logs(
     status: Optional[DoseStatus] = None,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    fields: Optional[str] = None,
     current_user: dict = Depends(get_current_user_dep)
 ):
-    """Get dose logs with optional filters"""
+    """Get dose logs with optional filters, latest first.
+
+    The next page's cursor is returned in the X-Next-Cursor header; with
+    stream=true all matching doses are sent as NDJSON. fields=drug_name,status
+    limits each dose to the listed fields.
+    """
+    selected = parse_fields(fields, DoseLog)
+    limit = page_size(limit, cursor)
+    try:
+        start = parse_datetime(start_date) if start_date else None
+        end = parse_datetime(end_date) if end_date else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date filter")
+
     query = {"user_id": current_user["id"]}
     if medication_id:
         query["medication_id"] = medication_id
     if status:
         query["status"] = status
-    if start_date:
-        query["scheduled_time"] = {"$gte": start_date}
-    if end_date:
+    if start:
+        query["scheduled_time"] = {"$gte": start}
+    if end:
         if "scheduled_time" not in query:
             query["scheduled_time"] = {}
-        query["scheduled_time"]["$lte"] = end_date
+        query["scheduled_time"]["$lte"] = end
+
+    # Merge in scheduled doses that only exist virtually
+    virtual_doses = []
+    if status in (None, DoseStatus.SCHEDULED):
+        now = datetime.utcnow()
+        window_start = start or now - timedelta(days=DEFAULT_PAST_DAYS)
+        window_end = end or now + timedelta(days=DEFAULT_FUTURE_DAYS)
+        window_start = max(window_start, window_end - timedelta(days=MAX_EXPANSION_DAYS))
+
+        virtual_doses = await expand_virtual_doses(current_user["id"], window_start, window_end, medication_id)
+        if cursor:
+            try:
+                after = dose_order_key(*decode_cursor(cursor))
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            virtual_doses = [dose for dose in virtual_doses if dose_order_key(dose.scheduled_time, dose.id) < after]
+        virtual_doses.sort(key=lambda d: dose_order_key(d.scheduled_time, d.id), reverse=True)
+    virtual_docs = [to_document(dose) for dose in virtual_doses]
+
+    dose_projection = projection(selected, "scheduled_time")
+    if stream:
+        stored = find_all(db.dose_logs, query, "scheduled_time", DESCENDING, cursor, dose_projection)
+        return StreamingResponse(
+            ndjson_lines(merge_dose_stream(stored, virtual_docs), DoseLog, selected),
+            media_type="application/x-ndjson"
+        )
 
-    doses = await db.dose_logs.find(query).sort("scheduled_time", -1).to_list(1000)
-    return [DoseLog(**dose) for dose in doses]
+    stored, next_cursor = await fetch_page(
+        db.dose_logs, query, "scheduled_time", DESCENDING, limit, cursor, dose_projection
+    )
+    doses = stored + virtual_docs
+    doses.sort(key=lambda d: dose_order_key(d["scheduled_time"], d["_id"]), reverse=True)
+    headers = {}
+    if next_cursor or len(doses) > limit:
+        doses = doses[:limit]
+        last = doses[-1]
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(parse_datetime(last["scheduled_time"]), last["_id"])
+    return json_response(doses, DoseLog, selected, headers)
 
 
 @api_router.get("/doses/{dose_id}", response_model=DoseLog)
@@ -460,10 +706,15 @@ async def get_dose_log(
     current_user: dict = Depends(get_current_user_dep)
 ):
     """Get a specific dose log"""
-    dose = await db.dose_logs.find_one({"id": dose_id, "user_id": current_user["id"]})
-    if not dose:
+    dose = await db.dose_logs.find_one({"_id": dose_id, "user_id": current_user["id"]})
+    if dose:
+        return DoseLog(**dose)
+
+    virtual = await find_virtual_dose(dose_id, current_user["id"])
+    if not virtual:
         raise HTTPException(status_code=404, detail="Dose log not found")
-    return DoseLog(**dose)
+    compiled, scheduled_time = virtual
+    return compiled.virtual_dose(scheduled_time)
 
 
 @api_router.put("/doses/{dose_id}", response_model=DoseLog)
@@ -473,18 +724,15 @@ async def update_dose_log(
     current_user: dict = Depends(get_current_user_dep)
 ):
     """Update a dose log (e.g., mark as taken)"""
-    existing = await db.dose_logs.find_one({"id": dose_id, "user_id": current_user["id"]})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Dose log not found")
-
     update_data = {k: v for k, v in dose.dict().items() if v is not None}
-    update_data["updated_at"] = datetime.utcnow().isoformat()
+    update_data["updated_at"] = datetime.utcnow()
 
     if dose.actual_time:
-        update_data["actual_time"] = dose.actual_time.isoformat()
+        update_data["actual_time"] = parse_datetime(dose.actual_time)
 
-    await db.dose_logs.update_one({"id": dose_id}, {"$set": update_data})
-    updated_dose = await db.dose_logs.find_one({"id": dose_id})
+    updated_dose = await apply_dose_update(dose_id, current_user["id"], update_data)
+    if not updated_dose:
+        raise HTTPException(status_code=404, detail="Dose log not found")
     return DoseLog(**updated_dose)
 
 
@@ -495,23 +743,246 @@ async def mark_dose_taken(
     current_user: dict = Depends(get_current_user_dep)
 ):
     """Quick action to mark a dose as taken"""
-    existing = await db.dose_logs.find_one({"id": dose_id, "user_id": current_user["id"]})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Dose log not found")
-
     update_data = {
         "status": DoseStatus.TAKEN,
-        "actual_time": datetime.utcnow().isoformat(),
-        "updated_at": datetime.utcnow().isoformat()
+        "actual_time": datetime.utcnow(),
+        "updated_at": datetime.utcnow()
     }
     if notes:
         update_data["notes"] = notes
 
-    await db.dose_logs.update_one({"id": dose_id}, {"$set": update_data})
-    updated_dose = await db.dose_logs.find_one({"id": dose_id})
+    updated_dose = await apply_dose_update(dose_id, current_user["id"], update_data)
+    if not updated_dose:
+        raise HTTPException(status_code=404, detail="Dose log not found")
     return DoseLog(**updated_dose)
 
 
+@api_router.post("/doses/bulk", response_model=DoseBulkResponse)
+async def bulk_update_doses(
+    update: DoseBulkUpdate,
+    current_user: dict = Depends(get_current_user_dep)
+):
+    """Set the status of many doses at once, e.g. a whole morning's pills.
+
+    All writes go out in one unordered bulk_write scoped to the caller, and
+    each dose gets its own result, so an unknown id does not fail the rest.
+    Every write is guarded on the status the rollups are moved from; a dose
+    that changed in the meantime is left alone and reported as a conflict.
+    """
+    dose_ids = [item.id for item in update.doses]
+    if len(dose_ids) > MAX_BULK_DOSES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_DOSES} doses per request")
+    if len(set(dose_ids)) != len(dose_ids):
+        raise HTTPException(status_code=400, detail="Duplicate dose ids")
+
+    user_id = current_user["id"]
+    # Also marks the writes made here, to tell them apart after the bulk_write
+    now = mongo_precision(datetime.utcnow())
+    stored = {
+        dose["_id"]: dose
+        for dose in await db.dose_logs.find(
+            {"_id": {"$in": dose_ids}, "user_id": user_id},
+            {"user_id": 1, "medication_id": 1, "scheduled_time": 1, "status": 1}
+        ).to_list(None)
+    }
+    virtual = await virtual_dose_documents([dose_id for dose_id in dose_ids if dose_id not in stored], user_id)
+
+    operations, targets = [], []
+    for item in update.doses:
+        update_data = {"status": item.status, "updated_at": now}
+        if item.actual_time:
+            update_data["actual_time"] = parse_datetime(item.actual_time)
+        elif item.status == DoseStatus.TAKEN:
+            update_data["actual_time"] = now
+        if item.notes:
+            update_data["notes"] = item.notes
+
+        if item.id in stored:
+            operations.append(UpdateOne(
+                {"_id": item.id, "user_id": user_id, "status": stored[item.id].get("status")},
+                {"$set": update_data}
+            ))
+            targets.append((item, stored[item.id]))
+        elif item.id in virtual:
+            # Store the occurrence with its new status in the same write. If
+            # another request stored it first, only a still SCHEDULED dose
+            # matches; any other status makes the upsert a duplicate key.
+            on_insert = {k: v for k, v in virtual[item.id].items() if k != "_id" and k not in update_data}
+            operations.append(UpdateOne(
+                {"_id": item.id, "user_id": user_id, "status": DoseStatus.SCHEDULED},
+                {"$set": update_data, "$setOnInsert": on_insert},
+                upsert=True
+            ))
+            targets.append((item, virtual[item.id]))
+
+    failed, conflicts, upserted = set(), set(), set()
+    matched = 0
+    if operations:
+        try:
+            result = await db.dose_logs.bulk_write(operations, ordered=False)
+            upserted = set(result.upserted_ids.values())
+            matched = result.matched_count
+        except BulkWriteError as e:
+            for error in e.details["writeErrors"]:
+                (conflicts if error["code"] == DUPLICATE_KEY else failed).add(error["index"])
+            if failed:
+                logger.error(f"Bulk dose update failed for {len(failed)} doses: {e}")
+            upserted = {entry["_id"] for entry in e.details["upserted"]}
+            matched = e.details["nMatched"]
+
+        if matched + len(upserted) < len(operations) - len(failed) - len(conflicts):
+            # Some stored doses changed status since they were read; only
+            # the ones carrying this request's timestamp were written here
+            written = {
+                dose["_id"] for dose in await db.dose_logs.find(
+                    {"_id": {"$in": list(stored)}, "updated_at": now}, {"_id": 1}
+                ).to_list(None)
+            }
+            conflicts |= {
+                index for index, (item, _) in enumerate(targets) if item.id in stored and item.id not in written
+            }
+
+    rollup_updates = []
+    outcomes = {}
+    for index, (item, dose) in enumerate(targets):
+        if index in failed:
+            outcomes[item.id] = DoseBulkResult(id=item.id, success=False, message="Update failed")
+            continue
+        if index in conflicts:
+            outcomes[item.id] = DoseBulkResult(id=item.id, success=False, message="Dose changed concurrently, please retry")
+            continue
+        if item.id in stored:
+            increments = status_increments(dose.get("status"), item.status)
+        elif item.id in upserted:
+            increments = status_increments(None, item.status, stored=1)
+        else:
+            # Stored concurrently by another request, matched while still SCHEDULED
+            increments = status_increments(DoseStatus.SCHEDULED, item.status)
+        if increments:
+            rollup_updates.append(rollup_update(dose["user_id"], dose["medication_id"], dose["scheduled_time"], increments))
+        outcomes[item.id] = DoseBulkResult(id=item.id, success=True, status=item.status)
+    if rollup_updates:
+        await db.daily_adherence.bulk_write(rollup_updates, ordered=False)
+        earliest = min(parse_datetime(dose["scheduled_time"]) for _, dose in targets)
+        await invalidate_streak(db, user_id, earliest)
+
+    results = [
+        outcomes.get(dose_id) or DoseBulkResult(id=dose_id, success=False, message="Dose log not found")
+        for dose_id in dose_ids
+    ]
+    return DoseBulkResponse(updated=sum(1 for r in results if r.success), results=results)
+
+
+# ============ PLASMA LEVEL ROUTES ============
+
+@api_router.get("/plasma-levels", response_model=PlasmaLevelTimeline)
+async def get_plasma_levels(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    resolution: float = Query(0.25, gt=0, description="Hours between samples"),
+    include_series: bool = True,
+    current_user: dict = Depends(get_current_user_dep)
+):
+    """Get estimated combined plasma levels of each active medication over a time window"""
+    now = datetime.utcnow()
+    start = parse_datetime(start) if start else now - timedelta(hours=24)
+    end = parse_datetime(end) if end else now + timedelta(hours=24)
+    span_hours = (end - start).total_seconds() / 3600
+    if span_hours <= 0 or span_hours > MAX_PLASMA_WINDOW_HOURS:
+        raise HTTPException(status_code=400, detail="Invalid time window")
+    if span_hours / resolution > MAX_CONCENTRATION_POINTS:
+        raise HTTPException(status_code=400, detail="Resolution too fine for the requested time window")
+
+    medications = await db.medications.find(
+        {"user_id": current_user["id"], "active": True},
+        {"drug_id": 1, "drug_name": 1, "dosage": 1}
+    ).to_list(1000)
+    if not medications:
+        return PlasmaLevelTimeline(start=start, end=end, resolution=resolution)
+
+    drug_ids = list({med["drug_id"] for med in medications})
+    drugs = await db.drugs.find(
+        {"_id": {"$in": drug_ids}},
+        {"pharmacokinetics": 1}
+    ).to_list(len(drug_ids))
+    pk_by_drug = {
+        drug["_id"]: Pharmacokinetics(**drug["pharmacokinetics"]) if drug.get("pharmacokinetics") else None
+        for drug in drugs
+    }
+    params = pk_parameters([pk_by_drug.get(med["drug_id"]) for med in medications])
+    med_index = {med["_id"]: i for i, med in enumerate(medications)}
+
+    # Only doses that can still contribute inside the window are fetched
+    lookback = timedelta(hours=float(washout_hours(params).max()))
+    doses = await db.dose_logs.find(
+        {
+            "user_id": current_user["id"],
+            "medication_id": {"$in": list(med_index)},
+            "status": {"$in": [DoseStatus.TAKEN, DoseStatus.SCHEDULED]},
+            "scheduled_time": {
+                "$gte": start - lookback,
+                "$lte": end
+            }
+        },
+        {"_id": 0, "medication_id": 1, "dosage": 1, "status": 1, "scheduled_time": 1, "actual_time": 1}
+    ).to_list(None)
+
+    dose_group, dose_times, dose_amounts = [], [], []
+    for dose in doses:
+        if dose["status"] == DoseStatus.TAKEN:
+            taken_at = parse_datetime(dose.get("actual_time") or dose["scheduled_time"])
+        else:
+            # Upcoming doses only; past doses that were never taken add nothing
+            taken_at = parse_datetime(dose["scheduled_time"])
+            if taken_at < now:
+                continue
+        group = med_index[dose["medication_id"]]
+        amount = parse_dose_amount(dose.get("dosage") or medications[group]["dosage"])
+        dose_group.append(group)
+        dose_times.append((taken_at - start).total_seconds() / 3600)
+        dose_amounts.append(amount or DEFAULT_DOSE_AMOUNT)
+
+    # Upcoming doses that were never stored come from the schedules
+    if end > now:
+        for dose in await expand_virtual_doses(current_user["id"], now, end):
+            group = med_index[dose.medication_id]
+            dose_group.append(group)
+            dose_times.append((dose.scheduled_time - start).total_seconds() / 3600)
+            dose_amounts.append(parse_dose_amount(dose.dosage) or DEFAULT_DOSE_AMOUNT)
+
+    times = sample_times(span_hours, resolution) if include_series else np.empty(0)
+    # The current level is evaluated as one extra sample at the end
+    sample_points = np.append(times, (now - start).total_seconds() / 3600)
+    dose_group = np.array(dose_group, dtype=int)
+    levels = superpose_doses(
+        params,
+        dose_drug=dose_group,
+        dose_times=np.array(dose_times, dtype=float),
+        dose_amounts=np.array(dose_amounts, dtype=float),
+        dose_group=dose_group,
+        n_groups=len(medications),
+        times=sample_points
+    )
+
+    return PlasmaLevelTimeline(
+        start=start,
+        end=end,
+        resolution=resolution,
+        times=np.round(times, 4).tolist(),
+        medications=[
+            PlasmaLevelSeries(
+                medication_id=med["_id"],
+                drug_id=med["drug_id"],
+                drug_name=med["drug_name"],
+                dosage=med["dosage"],
+                current_level=round(float(levels[i, -1]), 4),
+                levels=np.round(levels[i, :-1], 4).tolist()
+            )
+            for i, med in enumerate(medications)
+        ]
+    )
+
+
 # ============ PROGRESS TRACKING ROUTES ============
 
 @api_router.get("/progress", response_model=ProgressTracking)
@@ -522,40 +993,52 @@ async def get_progress(
     """Get progress statistics for the specified number of days"""
     end_date = datetime.utcnow()
     start_date = end_date - timedelta(days=days)
+    first_day = start_date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if current_user.get("adherence_rollups"):
+        # Read the per-day, per-medication rollups of the period
+        rows = await db.daily_adherence.find(
+            {
+                "user_id": current_user["id"],
+                "date": {"$gte": rollup_date(start_date), "$lte": rollup_date(end_date)}
+            },
+            {"_id": 0, "date": 1, "medication_id": 1, "scheduled": 1, "taken": 1, "missed": 1, "skipped": 1}
+        ).to_list(None)
+        totals = {key: sum(row.get(key, 0) for row in rows) for key in ROLLUP_COUNTERS}
+    else:
+        # No rollups yet: count inside MongoDB, then build them for next time
+        result = await db.dose_logs.aggregate(
+            progress_pipeline(current_user["id"], first_day, end_date)
+        ).to_list(1)
+        rows = result[0]["days"]
+        totals = result[0]["totals"][0] if result[0]["totals"] else {}
+        await backfill_adherence_rollups(current_user["id"])
+        invalidate_user(current_user["email"])
+
+    daily_stats = {}
+    stored_counts = {}
+    for row in rows:
+        stats = daily_stats.setdefault(row["date"], {"scheduled": 0, "taken": 0, "missed": 0})
+        for key in stats:
+            stats[key] += row.get(key, 0)
+        stored_counts[(row["medication_id"], row["date"])] = row.get("scheduled", 0)
+    total_scheduled = totals.get("scheduled", 0)
+    taken = totals.get("taken", 0)
+    missed = totals.get("missed", 0)
+    skipped = totals.get("skipped", 0)
+
+    # Past doses nobody acted on exist only virtually but still count as scheduled
+    for (medication_id, date), expected in (await expected_dose_counts(current_user["id"], first_day, end_date)).items():
+        pending = expected - stored_counts.get((medication_id, date), 0)
+        if pending > 0:
+            daily_stats.setdefault(date, {"scheduled": 0, "taken": 0, "missed": 0})["scheduled"] += pending
+            total_scheduled += pending
 
-    # Get all dose logs in the period
-    doses = await db.dose_logs.find({
-        "user_id": current_user["id"],
-        "scheduled_time": {
-            "$gte": start_date.isoformat(),
-            "$lte": end_date.isoformat()
-        }
-    }).to_list(10000)
-    
-    # Calculate statistics
-    total_scheduled = len(doses)
-    taken = len([d for d in doses if d.get("status") == DoseStatus.TAKEN])
-    missed = len([d for d in doses if d.get("status") == DoseStatus.MISSED])
-    skipped = len([d for d in doses if d.get("status") == DoseStatus.SKIPPED])
-    
     adherence_rate = (taken / total_scheduled * 100) if total_scheduled > 0 else 0
 
     # Get active medications count
     active_meds = await db.medications.count_documents({"user_id": current_user["id"], "active": True})
-    
-    # Calculate daily adherence
-    daily_stats = {}
-    for dose in doses:
-        date_str = dose.get("scheduled_time", "")[:10]  # YYYY-MM-DD
-        if date_str not in daily_stats:
-            daily_stats[date_str] = {"scheduled": 0, "taken": 0, "missed": 0}
-        
-        daily_stats[date_str]["scheduled"] += 1
-        if dose.get("status") == DoseStatus.TAKEN:
-            daily_stats[date_str]["taken"] += 1
-        elif dose.get("status") == DoseStatus.MISSED:
-            daily_stats[date_str]["missed"] += 1
-    
+
     daily_adherence = [
         DailyAdherence(
             date=date,
@@ -567,9 +1050,17 @@ async def get_progress(
         for date, stats in sorted(daily_stats.items())
     ]
     
-    # Calculate streak
-    current_streak = calculate_streak(daily_adherence)
-    
+    # Streaks through yesterday are kept per user; today is still open
+    streak = await get_streak(db, current_user["id"], end_date)
+    current_streak, last_perfect_date = streak["current"], streak["last_perfect_date"]
+    today = daily_stats.get(rollup_date(end_date))
+    if today and today["scheduled"]:
+        if today["taken"] >= today["scheduled"]:
+            current_streak += 1
+            last_perfect_date = rollup_date(end_date)
+        else:
+            current_streak = 0
+
     stats = ProgressStats(
         total_doses_scheduled=total_scheduled,
         doses_taken=taken,
@@ -577,7 +1068,8 @@ async def get_progress(
         doses_skipped=skipped,
         adherence_rate=round(adherence_rate, 2),
         current_streak=current_streak,
-        longest_streak=current_streak,  # TODO: Implement proper longest streak calculation
+        longest_streak=max(streak["longest"], current_streak),
+        last_perfect_date=last_perfect_date,
         total_active_medications=active_meds
     )
     
@@ -594,46 +1086,244 @@ async def get_progress(
 
 # ============ HELPER FUNCTIONS ============
 
-async def generate_dose_logs(medication: MedicationSchedule):
-    """Generate dose logs for a medication schedule"""
-    # For MVP, generate logs for next 7 days
-    days_to_generate = 7
-    start_date = medication.start_date
-    
-    for day in range(days_to_generate):
-        current_date = start_date + timedelta(days=day)
-        
-        # Generate logs based on frequency
-        for time_str in medication.specific_times:
-            hour, minute = map(int, time_str.split(":"))
-            scheduled_time = current_date.replace(hour=hour, minute=minute, second=0, microsecond=0)
-            
-            dose_log = DoseLog(
-                user_id=medication.user_id,
-                medication_id=medication.id,
-                drug_name=medication.drug_name,
-                dosage=medication.dosage,
-                scheduled_time=scheduled_time,
-                status=DoseStatus.SCHEDULED
-            )
-            
-            dose_dict = dose_log.dict()
-            dose_dict["scheduled_time"] = dose_log.scheduled_time.isoformat()
-            dose_dict["created_at"] = dose_log.created_at.isoformat()
-            dose_dict["updated_at"] = dose_log.updated_at.isoformat()
-            
-            await db.dose_logs.insert_one(dose_dict)
-
-
-def calculate_streak(daily_adherence: List[DailyAdherence]) -> int:
-    """Calculate current streak of days with 100% adherence"""
-    streak = 0
-    for day in reversed(daily_adherence):
-        if day.rate == 100.0:
-            streak += 1
-        else:
-            break
-    return streak
+async def find_virtual_dose(dose_id: str, user_id: str):
+    """Resolve a virtual dose id to (compiled schedule, scheduled time)"""
+    parsed = parse_virtual_dose_id(dose_id)
+    if not parsed:
+        return None
+    medication_id, scheduled_time = parsed
+    medication = await db.medications.find_one({"_id": medication_id, "user_id": user_id})
+    if not medication:
+        return None
+    compiled = CompiledSchedule(MedicationSchedule(**medication))
+    if not compiled.is_occurrence(scheduled_time):
+        return None
+    return compiled, scheduled_time
+
+
+async def virtual_dose_documents(dose_ids: List[str], user_id: str) -> dict:
+    """Stored forms of the valid virtual doses among dose_ids, by id"""
+    parsed = {dose_id: parse_virtual_dose_id(dose_id) for dose_id in dose_ids}
+    parsed = {dose_id: occurrence for dose_id, occurrence in parsed.items() if occurrence}
+    if not parsed:
+        return {}
+    medication_ids = list({medication_id for medication_id, _ in parsed.values()})
+    medications = await db.medications.find({"_id": {"$in": medication_ids}, "user_id": user_id}).to_list(None)
+    schedules = {med["_id"]: CompiledSchedule(MedicationSchedule(**med)) for med in medications}
+
+    documents = {}
+    for dose_id, (medication_id, scheduled_time) in parsed.items():
+        schedule = schedules.get(medication_id)
+        if schedule and schedule.is_occurrence(scheduled_time):
+            documents[dose_id] = virtual_dose_document(schedule, scheduled_time)
+    return documents
+
+
+async def materialize_virtual_dose(dose_id: str, user_id: str) -> Optional[dict]:
+    """Store a virtual dose as a SCHEDULED dose log so its state can change"""
+    virtual = await find_virtual_dose(dose_id, user_id)
+    if not virtual:
+        return None
+    dose_dict = virtual_dose_document(*virtual)
+    # Upsert so concurrent first writes to the same dose create one document
+    result = await db.dose_logs.update_one(
+        {"_id": dose_id, "user_id": user_id},
+        {"$setOnInsert": {key: value for key, value in dose_dict.items() if key != "_id"}},
+        upsert=True
+    )
+    if result.upserted_id:
+        await record_dose_change(db, dose_dict, None, DoseStatus.SCHEDULED, stored=1)
+    return dose_dict
+
+
+async def apply_dose_update(dose_id: str, user_id: str, update_data: dict) -> Optional[dict]:
+    """$set fields on one of the user's doses and return it as updated, or None.
+
+    The write returns the document as it was, so the rollups can be moved
+    off the previous status without another read; the updated document is
+    that plus the new fields. A virtual dose is materialized first.
+    """
+    query = {"_id": dose_id, "user_id": user_id}
+    previous = await db.dose_logs.find_one_and_update(query, {"$set": update_data})
+    if not previous and await materialize_virtual_dose(dose_id, user_id):
+        previous = await db.dose_logs.find_one_and_update(query, {"$set": update_data})
+    if not previous:
+        return None
+    if "status" in update_data and previous.get("status") != update_data["status"]:
+        await record_dose_change(db, previous, previous.get("status"), update_data["status"])
+        await invalidate_streak(db, user_id, previous["scheduled_time"])
+    return {**previous, **update_data}
+
+
+async def expand_virtual_doses(
+    user_id: str,
+    window_start: datetime,
+    window_end: datetime,
+    medication_id: Optional[str] = None
+) -> List[DoseLog]:
+    """Schedule occurrences in the window that have no stored dose log"""
+    query = {"user_id": user_id, **schedules_in_effect(window_start)}
+    if medication_id:
+        query["_id"] = medication_id
+    medications = await db.medications.find(query).to_list(1000)
+    if not medications:
+        return []
+    schedules = [CompiledSchedule(MedicationSchedule(**med)) for med in medications]
+
+    stored = await db.dose_logs.find(
+        {
+            "user_id": user_id,
+            "medication_id": {"$in": [schedule.medication.id for schedule in schedules]},
+            "scheduled_time": {"$gte": window_start, "$lte": window_end}
+        },
+        {"_id": 0, "medication_id": 1, "scheduled_time": 1}
+    ).to_list(None)
+    stored_keys = {dose_key(dose["medication_id"], parse_datetime(dose["scheduled_time"])) for dose in stored}
+
+    return [
+        schedule.virtual_dose(scheduled_time)
+        for schedule in schedules
+        for scheduled_time in schedule.occurrences(window_start, window_end)
+        if dose_key(schedule.medication.id, scheduled_time) not in stored_keys
+    ]
+
+
+def dose_order_key(scheduled_time, dose_id: str) -> Tuple[datetime, str]:
+    """Sort key matching the dose log keyset order (scheduled_time, _id)"""
+    return parse_datetime(scheduled_time), dose_id
+
+
+async def merge_dose_stream(stored, virtual_docs: List[dict]):
+    """Stored dose documents from a cursor interleaved with sorted virtual ones, latest first"""
+    pending = iter(virtual_docs)
+    upcoming = next(pending, None)
+    async for dose in stored:
+        key = dose_order_key(dose["scheduled_time"], dose["_id"])
+        while upcoming is not None and dose_order_key(upcoming["scheduled_time"], upcoming["_id"]) > key:
+            yield upcoming
+            upcoming = next(pending, None)
+        yield dose
+    while upcoming is not None:
+        yield upcoming
+        upcoming = next(pending, None)
+
+
+def catalog_validators(drugs: List[dict]) -> Tuple[str, Optional[datetime]]:
+    """ETag and Last-Modified for a set of catalog documents, based on updated_at"""
+    digest = hashlib.sha1()
+    for drug in drugs:
+        digest.update(f"{drug['_id']}:{drug.get('updated_at')};".encode())
+    last_modified = max((parse_datetime(drug["updated_at"]) for drug in drugs if drug.get("updated_at")), default=None)
+    return f'W/"{digest.hexdigest()}"', last_modified
+
+
+def validator_headers(etag: str, last_modified: Optional[datetime]) -> dict:
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if last_modified:
+        headers["Last-Modified"] = format_datetime(last_modified.replace(tzinfo=timezone.utc), usegmt=True)
+    return headers
+
+
+def not_modified(request: Request, etag: str, last_modified: Optional[datetime]) -> bool:
+    """Evaluate the conditional GET headers sent by the client"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            since = parse_datetime(parsedate_to_datetime(if_modified_since))
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have whole-second precision
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
+async def refresh_drug_search_index():
+    """Rebuild the drug search index from the database"""
+    drugs = await db.drugs.find({}).to_list(None)
+    drug_search_index.build(drugs)
+    logger.info(f"Drug search index built with {len(drugs)} drugs")
+
+
+async def expected_dose_counts(user_id: str, window_start: datetime, window_end: datetime) -> dict:
+    """Number of schedule occurrences per (medication_id, date) in the window"""
+    medications = await db.medications.find({"user_id": user_id, **schedules_in_effect(window_start)}).to_list(1000)
+    return expected_counts(medications, window_start, window_end)
+
+
+async def backfill_adherence_rollups(user_id: str):
+    """Build rollups from raw dose logs for users from before rollups existed"""
+    rows = await db.dose_logs.aggregate(backfill_pipeline(user_id)).to_list(None)
+    operations = [
+        UpdateOne(
+            {"user_id": user_id, "date": row["date"], "medication_id": row["medication_id"]},
+            {"$set": {**row, "user_id": user_id, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+        for row in rows
+    ]
+    if operations:
+        await db.daily_adherence.bulk_write(operations, ordered=False)
+    await db.users.update_one({"_id": user_id}, {"$set": {"adherence_rollups": True}})
+
+
+async def rematerialize_dose_logs(medication: MedicationSchedule) -> int:
+    """Bring stored future SCHEDULED dose logs in line with an edited schedule.
+
+    Only logs that were already materialized are reconciled; the rest of the
+    schedule is expanded virtually. Taken, missed and skipped logs are never
+    touched. Deletions go out in one unordered bulk_write; moved logs are
+    deleted together and stored again under the virtual id of their new
+    time. Returns the number of logs changed.
+    """
+    now = datetime.utcnow()
+    future = await db.dose_logs.find({
+        "medication_id": medication.id,
+        "user_id": medication.user_id,
+        "scheduled_time": {"$gte": now}
+    }).to_list(None)
+    existing = [log for log in future if log.get("status") == DoseStatus.SCHEDULED]
+    if not existing:
+        return 0
+    occupied = [parse_datetime(log["scheduled_time"]) for log in future if log.get("status") != DoseStatus.SCHEDULED]
+
+    desired = []
+    if medication.active:
+        # Through the end of the last log's day, so it can still move within that day
+        last = max(parse_datetime(log["scheduled_time"]) for log in existing)
+        horizon = last.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1) - timedelta(microseconds=1)
+        desired = list(CompiledSchedule(medication).occurrences(now, horizon))
+
+    operations, moves, dropped = plan_dose_log_changes(medication, existing, desired, now, occupied)
+    if operations:
+        await db.dose_logs.bulk_write(operations, ordered=False)
+    if moves:
+        moving = [log["_id"] for log, _ in moves]
+        await db.dose_logs.delete_many({"_id": {"$in": moving}, "status": DoseStatus.SCHEDULED})
+        # Logs acted on in the meantime were not deleted and stay where they are
+        kept = {log["_id"] for log in await db.dose_logs.find({"_id": {"$in": moving}}, {"_id": 1}).to_list(None)}
+        copies = [
+            moved_dose_document(log, medication, scheduled_time, now)
+            for log, scheduled_time in moves if log["_id"] not in kept
+        ]
+        if copies:
+            try:
+                await db.dose_logs.insert_many(copies, ordered=False)
+            except BulkWriteError as e:
+                # The new time was stored concurrently; the moved log is gone
+                failed = {error["index"] for error in e.details["writeErrors"] if error["code"] == DUPLICATE_KEY}
+                if len(failed) < len(e.details["writeErrors"]):
+                    raise
+                dropped += [copies[index] for index in failed]
+    if dropped:
+        # Moves stay on the same day, so only deletions change the rollups
+        await db.daily_adherence.bulk_write([
+            rollup_update(log["user_id"], log["medication_id"], log["scheduled_time"], {"scheduled": -1})
+            for log in dropped
+        ], ordered=False)
+    return len(dropped) + len(moves)
 
 
 # Include the router in the main app
@@ -645,6 +1335,7 @@ app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, "ETag"],
 )
 
 # Configure logging
@@ -654,6 +1345,64 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_db_indexes():
+    await ensure_indexes(db)
+
+
+@app.on_event("startup")
+async def build_drug_search_index():
+    await refresh_drug_search_index()
+
+
+@app.on_event("startup")
+async def start_drug_image_analyzer():
+    global drug_image_analyzer
+    drug_image_analyzer = create_analyzer()
+
+
+@app.on_event("startup")
+async def load_image_analysis_cache():
+    await image_analysis_cache.load()
+
+
+@app.on_event("startup")
+async def start_missed_dose_sweeper():
+    missed_dose_sweeper.start()
+
+
+@app.on_event("startup")
+async def start_reminder_scheduler():
+    reminder_scheduler.start(create_push_gateway())
+
+
+@app.on_event("shutdown")
+async def stop_missed_dose_sweeper():
+    await missed_dose_sweeper.stop()
+
+
+@app.on_event("shutdown")
+async def stop_reminder_scheduler():
+    await reminder_scheduler.stop()
+
+
+@app.on_event("shutdown")
+async def close_drug_image_analyzer():
+    analysis_jobs.cancel_all()
+    if drug_image_analyzer:
+        await drug_image_analyzer.close()
+
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+
+
+@app.on_event("shutdown")
+async def shutdown_password_hasher():
+    password_hasher.shutdown()
+
+
+@app.on_event("shutdown")
+async def shutdown_image_processor():
+    image_processor.shutdown()
@@ -0,0 +1,206 @@
+"""
+Adherence streaks for Medilog
+
+A day is perfect when every dose scheduled on it was taken; days without
+doses neither extend nor break a streak, as in the progress view. Instead
+of rescanning the rollups on every progress read, each user has one
+document in the adherence_streaks collection:
+
+    current             perfect days in a row up to evaluated_through
+    longest             longest run of perfect days
+    last_perfect_date   latest perfect day (YYYY-MM-DD)
+    evaluated_through   last finished day counted in
+
+A finished day is counted in once, on the first read after it ends, from
+its rollups plus the doses that only exist virtually. A later status
+change on a day already counted marks the document stale, and the next
+read recomputes it from the full history. Today is still open and is
+added on top by the caller.
+
+To compute the documents of all existing users in one pass over the
+rollups:
+
+    python streaks.py
+"""
+import asyncio
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+from adherence import expected_counts, rollup_date
+from scheduling import schedules_in_effect
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+# Occurrences of schedules are counted from here when recomputing history
+HISTORY_START = datetime(2000, 1, 1)
+
+Counts = Dict[Tuple[str, str], List[int]]
+
+
+def new_streak() -> dict:
+    return {"current": 0, "longest": 0, "last_perfect_date": None, "evaluated_through": None}
+
+
+def perfect_days(stored: Counts, expected: Dict[Tuple[str, str], int]) -> List[Tuple[str, bool]]:
+    """(date, perfect) of each day with doses, in date order.
+
+    `stored` holds [scheduled, taken] per (medication_id, date) from the
+    rollups; occurrences beyond the stored ones are pending, as in progress.
+    """
+    days: Dict[str, List[int]] = {}
+    for key in stored.keys() | expected.keys():
+        scheduled, taken = stored.get(key, (0, 0))
+        day = days.setdefault(key[1], [0, 0])
+        day[0] += max(scheduled, expected.get(key, 0))
+        day[1] += taken
+    return [(date, taken >= scheduled) for date, (scheduled, taken) in sorted(days.items()) if scheduled > 0]
+
+
+def fold_days(streak: dict, days: Iterable[Tuple[str, bool]], through: str) -> dict:
+    """Advance a streak over finished days in date order"""
+    for date, perfect in days:
+        if perfect:
+            streak["current"] += 1
+            streak["longest"] = max(streak["longest"], streak["current"])
+            streak["last_perfect_date"] = date
+        else:
+            streak["current"] = 0
+    streak["evaluated_through"] = through
+    return streak
+
+
+async def _stored_counts(db, user_id: str, first_date: Optional[str], last_date: str) -> Counts:
+    dates = {"$lte": last_date}
+    if first_date:
+        dates["$gte"] = first_date
+    rows = await db.daily_adherence.find(
+        {"user_id": user_id, "date": dates},
+        {"_id": 0, "date": 1, "medication_id": 1, "scheduled": 1, "taken": 1}
+    ).to_list(None)
+    return {(row["medication_id"], row["date"]): [row.get("scheduled", 0), row.get("taken", 0)] for row in rows}
+
+
+async def _evaluate(db, user_id: str, streak: dict, first_date: Optional[str], through: str) -> dict:
+    """Fold the finished days from first_date (or the beginning) through `through` into streak"""
+    start = datetime.strptime(first_date, "%Y-%m-%d") if first_date else HISTORY_START
+    medications = await db.medications.find({"user_id": user_id, **schedules_in_effect(start)}).to_list(1000)
+    end = datetime.strptime(through, "%Y-%m-%d") + timedelta(days=1) - timedelta(microseconds=1)
+    stored = await _stored_counts(db, user_id, first_date, through)
+    return fold_days(streak, perfect_days(stored, expected_counts(medications, start, end)), through)
+
+
+async def get_streak(db, user_id: str, now: datetime) -> dict:
+    """The user's streak through yesterday, counting in days finished since the last read"""
+    yesterday = rollup_date(now - timedelta(days=1))
+    state = await db.adherence_streaks.find_one({"_id": user_id})
+
+    if state is None or state.get("stale"):
+        streak = await _evaluate(db, user_id, new_streak(), None, yesterday)
+        guard = {"_id": user_id}
+    elif state["evaluated_through"] >= yesterday:
+        return state
+    else:
+        first_date = rollup_date(datetime.strptime(state["evaluated_through"], "%Y-%m-%d") + timedelta(days=1))
+        streak = await _evaluate(db, user_id, {key: state[key] for key in new_streak()}, first_date, yesterday)
+        # Skip the write if a stale mark or another read got there first
+        guard = {"_id": user_id, "evaluated_through": state["evaluated_through"], "stale": {"$ne": True}}
+
+    await db.adherence_streaks.update_one(
+        guard,
+        {"$set": {**streak, "stale": False, "updated_at": datetime.utcnow()}},
+        upsert=state is None
+    )
+    return streak
+
+
+async def invalidate_streak(db, user_id: str, scheduled_time=None):
+    """Mark the streak for recomputation if the dose's day was already counted in.
+
+    Without a time (e.g. a medication and its history were removed) it is
+    always marked.
+    """
+    query = {"_id": user_id}
+    if scheduled_time is not None:
+        query["evaluated_through"] = {"$gte": rollup_date(scheduled_time)}
+    await db.adherence_streaks.update_one(query, {"$set": {"stale": True}})
+
+
+async def backfill_streaks(db, now: Optional[datetime] = None, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """Compute every user's streak from the rollups in one ordered pass; returns the number written"""
+    yesterday = rollup_date((now or datetime.utcnow()) - timedelta(days=1))
+    end = datetime.strptime(yesterday, "%Y-%m-%d") + timedelta(days=1) - timedelta(microseconds=1)
+
+    medications: Dict[str, List[dict]] = {}
+    async for med in db.medications.find(schedules_in_effect(HISTORY_START)):
+        medications.setdefault(med["user_id"], []).append(med)
+
+    written = 0
+    operations = []
+
+    async def flush():
+        nonlocal written, operations
+        if operations:
+            await db.adherence_streaks.bulk_write(operations, ordered=False)
+            written += len(operations)
+            operations = []
+
+    def finish(user_id: str, stored: Counts):
+        expected = expected_counts(medications.pop(user_id, []), HISTORY_START, end)
+        streak = fold_days(new_streak(), perfect_days(stored, expected), yesterday)
+        operations.append(UpdateOne(
+            {"_id": user_id},
+            {"$set": {**streak, "stale": False, "updated_at": datetime.utcnow()}},
+            upsert=True
+        ))
+
+    # Sorted like the (user_id, date, medication_id) index, so each user's rows arrive together
+    user_id, stored = None, {}
+    cursor = db.daily_adherence.find(
+        {"date": {"$lte": yesterday}},
+        {"_id": 0, "user_id": 1, "date": 1, "medication_id": 1, "scheduled": 1, "taken": 1}
+    ).sort([("user_id", 1), ("date", 1), ("medication_id", 1)])
+    async for row in cursor:
+        if row["user_id"] != user_id:
+            if user_id is not None:
+                finish(user_id, stored)
+            user_id, stored = row["user_id"], {}
+            if len(operations) >= batch_size:
+                await flush()
+        stored[(row["medication_id"], row["date"])] = [row.get("scheduled", 0), row.get("taken", 0)]
+    if user_id is not None:
+        finish(user_id, stored)
+
+    # Users with schedules but no stored doses yet
+    for user_id in list(medications):
+        finish(user_id, {})
+        if len(operations) >= batch_size:
+            await flush()
+    await flush()
+    logger.info(f"Streaks computed for {written} users")
+    return written
+
+
+async def main() -> int:
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        written = await backfill_streaks(db)
+    finally:
+        client.close()
+    print(f"✓ Streaks computed for {written} users")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    sys.exit(asyncio.run(main()))
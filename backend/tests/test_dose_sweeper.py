@@ -0,0 +1,70 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from documents import to_document
+from dose_sweeper import MissedDoseSweeper
+from models import DoseLog, DoseStatus, MedicationSchedule
+from scheduling import virtual_dose_id
+
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+START = datetime(2025, 3, 1)
+# 13:00 in the default timezone (Europe/Istanbul), 05:00 in New York
+NOW = datetime(2025, 3, 3, 10, 0)
+MEDICATION = MedicationSchedule(
+    user_id="user", drug_id="drug", drug_name="Parol", dosage="500mg", dosage_form="tablet",
+    frequency="daily", specific_times=["08:00"], start_date=START
+)
+
+
+@pytest.fixture(autouse=True)
+def bulk_updates(monkeypatch):
+    """mongomock does not take the `sort` pymongo passes for UpdateOne in a bulk_write"""
+    from mongomock.collection import BulkOperationBuilder
+    add_update = BulkOperationBuilder.add_update
+    monkeypatch.setattr(BulkOperationBuilder, "add_update", lambda self, *args, sort=None, **kwargs: add_update(self, *args, **kwargs))
+
+
+def dose_log(day: int, **changes) -> DoseLog:
+    return DoseLog(
+        user_id="user", medication_id=MEDICATION.id, drug_name="Parol", dosage="500mg",
+        scheduled_time=datetime(2025, 3, day, 8, 0), **changes
+    )
+
+
+def sweep(timezone=None, logs=()):
+    """Sweep at NOW; returns the number marked and the (day, status) of every stored log"""
+    db = mongomock_motor.AsyncMongoMockClient()["test"]
+
+    async def run():
+        await db.users.insert_one({"_id": "user", "timezone": timezone})
+        await db.medications.insert_one(to_document(MEDICATION))
+        for log in logs:
+            await db.dose_logs.insert_one(to_document(log))
+        swept = await MissedDoseSweeper(db, grace_minutes=0).sweep(NOW)
+        doses = await db.dose_logs.find({}).sort("scheduled_time", 1).to_list(None)
+        return swept, [(dose["scheduled_time"].day, dose["status"]) for dose in doses]
+
+    return asyncio.run(run())
+
+
+def test_logged_dose_is_not_missed_again():
+    # Taken under an id of its own, as doses logged before virtual ids were
+    swept, doses = sweep(logs=[dose_log(2, status=DoseStatus.TAKEN)])
+    assert swept == 2
+    assert doses == [(1, DoseStatus.MISSED), (2, DoseStatus.TAKEN), (3, DoseStatus.MISSED)]
+
+
+def test_cutoff_follows_the_users_timezone():
+    # 08:00 on 3 March has not come yet in New York
+    swept, doses = sweep(timezone="America/New_York")
+    assert swept == 2
+    assert doses == [(1, DoseStatus.MISSED), (2, DoseStatus.MISSED)]
+
+    stored = dose_log(3, id=virtual_dose_id(MEDICATION.id, datetime(2025, 3, 3, 8, 0)))
+    swept, doses = sweep(timezone="America/New_York", logs=[stored])
+    assert doses[-1] == (3, DoseStatus.SCHEDULED)
+    swept, doses = sweep(logs=[stored])
+    assert doses[-1] == (3, DoseStatus.MISSED)
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+from adherence import expected_counts, rollup_date
+from documents import to_document
+from models import MedicationSchedule
+from scheduling import CompiledSchedule, moved_dose_document, plan_dose_log_changes, schedule_revision, virtual_dose_id
+from streaks import fold_days, new_streak, perfect_days
+
+START = datetime(2025, 3, 1)
+EDITED_AT = datetime(2025, 3, 7, 6, 0)
+
+
+def daily_medication(**changes) -> MedicationSchedule:
+    medication = MedicationSchedule(
+        user_id="user", drug_id="drug", drug_name="Parol", dosage="500mg", dosage_form="tablet",
+        frequency="daily", specific_times=["08:00"], start_date=START
+    )
+    return medication.model_copy(update=changes)
+
+
+def edit(medication: MedicationSchedule, at: datetime, **changes) -> MedicationSchedule:
+    """The medication as update_medication stores it after a schedule edit"""
+    history = [*medication.schedule_history, schedule_revision(to_document(medication))]
+    return MedicationSchedule(**{**to_document(medication), **changes, "schedule_changed_at": at, "schedule_history": history})
+
+
+def test_schedule_edit_keeps_past_doses():
+    # Taken once a day for six days, then edited to twice a day
+    edited = edit(daily_medication(), EDITED_AT, specific_times=["08:00", "20:00"])
+    past_end = EDITED_AT.replace(hour=0) - timedelta(microseconds=1)
+    expected = expected_counts([to_document(edited)], START, past_end)
+    assert expected == {(edited.id, rollup_date(START + timedelta(days=day))): 1 for day in range(6)}
+
+    stored = {key: [1, 1] for key in expected}
+    days = perfect_days(stored, expected)
+    assert days == [(rollup_date(START + timedelta(days=day)), True) for day in range(6)]
+    streak = fold_days(new_streak(), days, rollup_date(past_end))
+    assert (streak["current"], streak["longest"]) == (6, 6)
+
+
+def test_edited_schedule_applies_from_the_edit():
+    edited = CompiledSchedule(edit(daily_medication(), EDITED_AT, specific_times=["09:00", "20:00"]))
+    assert list(edited.occurrences(datetime(2025, 3, 6), datetime(2025, 3, 8, 12, 0))) == [
+        datetime(2025, 3, 6, 8, 0), datetime(2025, 3, 7, 9, 0), datetime(2025, 3, 7, 20, 0), datetime(2025, 3, 8, 9, 0)
+    ]
+    assert edited.is_occurrence(datetime(2025, 3, 6, 8, 0))
+    assert not edited.is_occurrence(datetime(2025, 3, 6, 9, 0))
+    assert not edited.is_occurrence(datetime(2025, 3, 8, 8, 0))
+
+
+def test_each_version_keeps_its_dosage_and_ids():
+    medication = daily_medication()
+    edited = edit(edit(medication, datetime(2025, 3, 3, 12, 0), dosage="1000mg"), EDITED_AT, active=False)
+    compiled = CompiledSchedule(edited)
+    doses = [compiled.virtual_dose(t) for t in compiled.occurrences(START, datetime(2025, 3, 10))]
+    assert [(dose.scheduled_time.day, dose.dosage) for dose in doses] == [
+        (1, "500mg"), (2, "500mg"), (3, "500mg"), (4, "1000mg"), (5, "1000mg"), (6, "1000mg")
+    ]
+    assert doses[0].id == virtual_dose_id(medication.id, datetime(2025, 3, 1, 8, 0))
+
+
+def test_moved_dose_log_is_rekeyed():
+    medication = daily_medication(specific_times=["09:00", "20:00"])
+    morning, evening = datetime(2025, 3, 8, 8, 0), datetime(2025, 3, 8, 20, 0)
+    log = {"_id": virtual_dose_id(medication.id, morning), "scheduled_time": morning, "dosage": "500mg", "notes": "with food"}
+    operations, moves, dropped = plan_dose_log_changes(medication, [log], [datetime(2025, 3, 8, 9, 0), evening])
+    assert (operations, dropped) == ([], [])
+    moved = moved_dose_document(log, medication, moves[0][1], EDITED_AT)
+    assert moved["_id"] == virtual_dose_id(medication.id, datetime(2025, 3, 8, 9, 0))
+    assert moved["notes"] == "with food"
+
+    # A time already logged in another state is not free to move to
+    operations, moves, dropped = plan_dose_log_changes(
+        medication, [log], [datetime(2025, 3, 8, 9, 0)], occupied=[datetime(2025, 3, 8, 9, 0)]
+    )
+    assert moves == [] and dropped == [log]
@@ -43,9 +43,11 @@ export const registerForPushNotificationsAsync = async (): Promise<string | null
       console.log('Push token:', token);
 
       // Register token with backend
+      // Reminders are sent at the dose times of the device's timezone
       await api.post('/auth/push-token', {
         token,
         device_type: Platform.OS,
+        timezone: Intl.DateTimeFormat().resolvedOptions().timeZone,
       });
     } catch (error) {
       console.error('Error getting push token:', error);